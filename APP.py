@@ -77,6 +77,11 @@ class BlockchainApp:
         self.amount_entry = ttk.Entry(transfer_frame)
         self.amount_entry.pack(pady=5)
         
+        # 手续费输入（可留空），手续费率高的交易优先被打包
+        ttk.Label(transfer_frame, text="手续费:").pack()
+        self.fee_entry = ttk.Entry(transfer_frame)
+        self.fee_entry.pack(pady=5)
+        
         # 转账按钮
         self.transfer_btn = ttk.Button(transfer_frame, text="转账", command=self.transfer)
         self.transfer_btn.pack(pady=5)
@@ -131,13 +136,14 @@ class BlockchainApp:
         try:
             recipient = self.address_entry.get()
             amount = float(self.amount_entry.get())
+            fee = float(self.fee_entry.get() or 0)
             
-            if not recipient or amount <= 0:
+            if not recipient or amount <= 0 or fee < 0:
                 messagebox.showerror("错误", "请输入有效的接收地址和转账金额")
                 return
                 
             # 创建交易
-            transaction = self.node.wallet.create_transaction(recipient, amount)
+            transaction = self.node.wallet.create_transaction(recipient, amount, fee)
             
             # 广播交易
             self.node.send_transaction(transaction)
@@ -147,6 +153,7 @@ class BlockchainApp:
             # 清空输入框
             self.address_entry.delete(0, tk.END)
             self.amount_entry.delete(0, tk.END)
+            self.fee_entry.delete(0, tk.END)
             
         except ValueError as e:
             messagebox.showerror("错误", str(e))
@@ -1,13 +1,106 @@
 import hashlib
+import math
+import re
+import struct
 import time
 import json
-from MerkleTree import MerkleTree, merkle_tree_from_json
+from MerkleTree import MerkleTree, merkle_tree_from_dict, merkle_tree_from_json
+from Codec import Reader, Writer
+from Transaction import Transaction
+
+
+BLOCK_VERSION = 1  # 当前区块头版本；版本0为旧的字符串拼接哈希
+HEADER_PREFIX = struct.Struct("<IQd32s32s")  # version, index, timestamp, merkle_root, previous_hash
+HEADER_NONCE = struct.Struct("<I")  # nonce放在区块头末尾，前缀在整个nonce搜索中保持不变
+LEAF_RAW = 0  # 二进制编码中原样保存的叶子
+LEAF_TRANSACTION = 1  # 二进制编码中按交易编码的叶子，解码时还原成相同的JSON字符串
+HASH_PATTERN = re.compile("[0-9a-f]{64}")  # sha256的十六进制摘要
+
+
+def block_header_prefix(version, index, timestamp, merkle_root, previous_hash):
+    # 区块头中除nonce以外的定长二进制部分
+    return HEADER_PREFIX.pack(
+        version, index, timestamp, bytes.fromhex(merkle_root), bytes.fromhex(previous_hash)
+    )
+
+
+def calculate_block_hash(index, timestamp, merkle_root, previous_hash, nonce, version=BLOCK_VERSION):
+    # 计算区块的hash值
+    # 这里我们使用sha256算法
+    # 只依赖区块头字段，挖矿进程无需持有整个区块
+    if version == 0:
+        # 旧版区块：把各字段转成字符串拼接后哈希
+        sha = hashlib.sha256()
+        sha.update(
+            str(index).encode("utf-8")
+            + str(timestamp).encode("utf-8")
+            + str(merkle_root).encode("utf-8")
+            + str(previous_hash).encode("utf-8")
+            + str(nonce).encode("utf-8")
+        )
+        return sha.hexdigest()
+    sha = hashlib.sha256(block_header_prefix(version, index, timestamp, merkle_root, previous_hash))
+    sha.update(HEADER_NONCE.pack(nonce))
+    return sha.hexdigest()
+
+
+def is_integer(value, low, high):
+    # bool也是int的子类，但不是合法的字段值
+    return type(value) is int and low <= value < high
+
+
+def check_header(header):
+    """检查收到的区块头字段的类型和范围，不合法时抛出ValueError。
+
+    区块头来自其他节点，计算哈希时struct.pack和bytes.fromhex对越界或格式错误的字段会抛出各种异常，
+    在解码时统一检查，之后的哈希和工作量证明检查就不会因为字段本身出错。
+    """
+    version = header.get('version', 0)
+    if not is_integer(version, 0, BLOCK_VERSION + 1):
+        raise ValueError(f"Unsupported block version {version!r}")
+    if not is_integer(header['index'], 0, 1 << 64):
+        raise ValueError(f"Invalid block index {header['index']!r}")
+    timestamp = header['timestamp']
+    if not (is_integer(timestamp, 0, 1 << 53) or type(timestamp) is float and 0 <= timestamp < math.inf):
+        raise ValueError(f"Invalid block timestamp {timestamp!r}")
+    if not isinstance(header['hash'], str) or not HASH_PATTERN.fullmatch(header['hash']):
+        raise ValueError(f"Invalid block hash {header['hash']!r}")
+    if version == 0:
+        # 旧版区块头按字符串拼接哈希，只要求字段类型正确（创世区块的previous_hash是"0"）
+        if not isinstance(header['merkle_root'], str) or not isinstance(header['previous_hash'], str):
+            raise ValueError("Block hashes must be strings")
+        if not is_integer(header['nonce'], 0, math.inf):
+            raise ValueError(f"Invalid block nonce {header['nonce']!r}")
+        return
+    for field in ('merkle_root', 'previous_hash'):
+        if not isinstance(header[field], str) or not HASH_PATTERN.fullmatch(header[field]):
+            raise ValueError(f"Invalid block {field} {header[field]!r}")
+    if not is_integer(header['nonce'], 0, 1 << 32):
+        raise ValueError(f"Invalid block nonce {header['nonce']!r}")
+
+
+def difficulty_target(difficulty):
+    # 难度为d时要求哈希前d位十六进制为0，即哈希值小于 2^(256-4d)
+    return 1 << (256 - 4 * difficulty)
+
+
+def block_work(difficulty):
+    # 找到一个满足难度的区块平均需要计算的哈希次数，用于比较各条链的累计工作量
+    return (1 << 256) // difficulty_target(difficulty)
+
+
+def hash_meets_difficulty(block_hash, difficulty, version=BLOCK_VERSION):
+    if version == 0:
+        return block_hash.startswith("0" * difficulty)
+    return int(block_hash, 16) < difficulty_target(difficulty)
 
 
 class Block:
     def __init__(
-        self, index, merkle_tree: MerkleTree, previous_hash, nonce, timestamp=None, miner_address=None
+        self, index, merkle_tree: MerkleTree, previous_hash, nonce, timestamp=None, miner_address=None,
+        version=BLOCK_VERSION
     ):
+        self.version = version  # 区块头版本
         self.index = index
         self.timestamp = time.time() if timestamp is None else timestamp  # 当前时间戳
         self.merkle_tree = merkle_tree
@@ -17,25 +110,74 @@ class Block:
         self.miner_address = miner_address  # 添加矿工节点的IP地址
         self.hash = self.calculate_hash()
 
+    @classmethod
+    def from_header(cls, header, load_merkle_tree, miner_address=None):
+        """只用区块头字段创建区块，区块体（默克尔树）在第一次访问时才调用load_merkle_tree解码"""
+        check_header(header)
+        block = cls.__new__(cls)
+        block.version = header.get('version', 0)
+        block.index = header['index']
+        block.timestamp = header['timestamp']
+        block._merkle_tree = None
+        block.load_merkle_tree = load_merkle_tree
+        block.merkle_root = header['merkle_root']
+        block.previous_hash = header['previous_hash']
+        block.nonce = header['nonce']
+        block.miner_address = miner_address
+        block.hash = header['hash']  # 直接使用收到的哈希值，由工作量证明检查核对
+        return block
+
+    @property
+    def merkle_tree(self):
+        if self._merkle_tree is None:
+            # 重建默克尔树并与区块头中的merkle_root核对，不一致时抛出ValueError
+            self._merkle_tree = self.load_merkle_tree()
+            self.load_merkle_tree = None
+        return self._merkle_tree
+
+    @merkle_tree.setter
+    def merkle_tree(self, merkle_tree):
+        self._merkle_tree = merkle_tree
+        self.load_merkle_tree = None
+
+    def is_body_valid(self):
+        # 解码区块体并检查它与区块头一致；比工作量证明检查贵得多，应放在最后
+        try:
+            return bool(self.merkle_tree.leaves)
+        except (ValueError, KeyError, TypeError):
+            return False
+
     def calculate_hash(self):
-        # 计算区块的hash值
-        # 这里我们使用sha256算法
-        sha = hashlib.sha256()
-        sha.update(
-            str(self.index).encode("utf-8")
-            + str(self.timestamp).encode("utf-8")
-            + str(self.merkle_root).encode("utf-8")
-            + str(self.previous_hash).encode("utf-8")
-            + str(self.nonce).encode("utf-8")
+        return calculate_block_hash(
+            self.index, self.timestamp, self.merkle_root, self.previous_hash, self.nonce, self.version
         )
-        return sha.hexdigest()
     
+    def header(self):
+        # 区块头字段（不含默克尔树），用于先同步区块头
+        return {
+            'version': self.version,
+            'index': self.index,
+            'timestamp': self.timestamp,
+            'merkle_root': self.merkle_root,
+            'previous_hash': self.previous_hash,
+            'nonce': self.nonce,
+            'hash': self.hash
+        }
+
+    def header_bytes(self):
+        # 定长二进制区块头（仅新版区块）
+        return block_header_prefix(
+            self.version, self.index, self.timestamp, self.merkle_root, self.previous_hash
+        ) + HEADER_NONCE.pack(self.nonce)
+
     def to_json(self):
         # 自定义序列化过程
         block_dict = {
+            'version': self.version,
             'index': self.index,
             'timestamp': self.timestamp,
-            'merkle_tree': self.merkle_tree.to_json(),
+            'merkle_root': self.merkle_root,
+            'merkle_tree': self.merkle_tree.to_dict(),  # 直接嵌入对象，避免JSON字符串再被转义一层
             'previous_hash': self.previous_hash,
             'nonce': self.nonce,
             'hash': self.hash,
@@ -43,6 +185,32 @@ class Block:
         }
         return json.dumps(block_dict, ensure_ascii=False)
 
+    def to_bytes(self, binary_transaction=None):
+        """二进制编码：哈希按原始字节保存，交易叶子按交易的二进制格式保存。
+        binary_transaction(叶子)返回可以按二进制格式保存的交易或None，传入交易缓存的方法可以避免重新解析叶子
+        """
+        binary_transaction = binary_transaction or (lambda leaf: leaf_transaction(leaf.data))
+        writer = Writer()
+        writer.varint(self.version)
+        writer.varint(self.index)
+        writer.number(self.timestamp)
+        writer.string(self.merkle_root)
+        writer.string(self.previous_hash)
+        writer.varint(self.nonce)
+        writer.string(self.hash)
+        writer.string(self.miner_address)
+        leaves = self.merkle_tree.leaves
+        writer.varint(len(leaves))
+        for leaf in leaves:
+            tx = binary_transaction(leaf)
+            if tx is None:
+                writer.byte(LEAF_RAW)
+                writer.string(leaf.data)
+            else:
+                writer.byte(LEAF_TRANSACTION)
+                tx.write(writer)
+        return writer.getvalue()
+
     def __str__(self, show_merkle_tree=False):
         if show_merkle_tree:
             return f"Block(index={self.index},\n timestamp={self.timestamp},\n merkle_root={self.merkle_root},\n previous_hash={self.previous_hash},\n hash={self.hash}) \n merkle tree: \n{self.merkle_tree.__str__()}"
@@ -186,29 +354,83 @@ class Block:
         with open(filename, "w") as f:
             f.write(svg_content)
 
+def is_header_valid(header, difficulty):
+    """只凭区块头检查哈希和工作量证明，不需要区块体"""
+    try:
+        check_header(header)
+        block_hash = calculate_block_hash(
+            header['index'], header['timestamp'], header['merkle_root'],
+            header['previous_hash'], header['nonce'], header.get('version', 0)
+        )
+        return block_hash == header['hash'] and hash_meets_difficulty(block_hash, difficulty, header.get('version', 0))
+    except (KeyError, TypeError, ValueError, struct.error):
+        return False
+
+
 def block_from_json(block_json):
     # 将JSON字符串解析为字典
     block_data = json.loads(block_json)
-    
-    # 从字典中提取构造Block对象所需的参数
-    index = block_data['index']
-    previous_hash = block_data['previous_hash']
-    nonce = block_data['nonce']
-    timestamp = block_data.get('timestamp', None)
-    
-    # 反序列化MerkleTree
-    merkle_tree_data = block_data['merkle_tree']
-    merkle_tree = merkle_tree_from_json(merkle_tree_data)
-    
-    # 创建并返回Block对象
-    block = Block(index, merkle_tree, previous_hash, nonce, timestamp)
-    block.hash = block_data['hash']  # 直接使用已保存的哈希值
-    block.miner_address = block_data['miner_address']
-    return block
+    if 'merkle_root' not in block_data:
+        # 旧版区块没有merkle_root字段，只能立即重建默克尔树得到它
+        merkle_tree = merkle_tree_from_json(block_data['merkle_tree'])
+        check_header(dict(block_data, merkle_root=merkle_tree.get_root_hash()))
+        block = Block(block_data['index'], merkle_tree, block_data['previous_hash'], block_data['nonce'],
+                      block_data.get('timestamp', None), version=block_data.get('version', 0))
+        block.hash = block_data['hash']  # 直接使用已保存的哈希值
+        block.miner_address = block_data['miner_address']
+        return block
+
+    def load_merkle_tree():
+        # 反序列化MerkleTree，并与区块头中的merkle_root比对
+        # 旧版区块的默克尔树是嵌套的JSON字符串
+        merkle_tree_data = block_data['merkle_tree']
+        if isinstance(merkle_tree_data, str):
+            return merkle_tree_from_json(merkle_tree_data, block_data['merkle_root'])
+        return merkle_tree_from_dict(merkle_tree_data, block_data['merkle_root'])
+
+    return Block.from_header(block_data, load_merkle_tree, block_data['miner_address'])
+
+
+def leaf_transaction(data):
+    # 叶子是交易且能从交易对象还原出完全相同的字符串时返回交易，否则返回None
+    try:
+        tx = Transaction.from_json(json.loads(data))
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+    return tx if json.dumps(tx.to_json()) == data else None
+
+
+def block_from_bytes(data):
+    reader = Reader(data)
+    header = {
+        'version': reader.varint(),
+        'index': reader.varint(),
+        'timestamp': reader.number(),
+        'merkle_root': reader.string(),
+        'previous_hash': reader.string(),
+        'nonce': reader.varint(),
+        'hash': reader.string(),
+    }
+    miner_address = reader.string()
+    body_start = reader.offset
+
+    def load_merkle_tree():
+        # 区块体紧跟在区块头之后，访问时才继续读取
+        reader.offset = body_start
+        leaves = []
+        for _ in range(reader.varint()):
+            if reader.byte() == LEAF_TRANSACTION:
+                leaves.append(json.dumps(Transaction.read(reader).to_json()))
+            else:
+                leaves.append(reader.string())
+        reader.end()
+        return merkle_tree_from_dict({'leaves': leaves}, header['merkle_root'])
+
+    return Block.from_header(header, load_merkle_tree, miner_address)
 
 
 if __name__ == "__main__":
-    block = Block(0, MerkleTree(["a", "b", "c"]), "0", 0)
+    block = Block(0, MerkleTree(["a", "b", "c"]), "0" * 64, 0)
     print(block)
     print(block.merkle_tree)
     print("--------------------------------")
@@ -216,3 +438,4 @@ if __name__ == "__main__":
     print(block)
     print(block.merkle_tree)
     print([leaf.data for leaf in block.merkle_tree.leaves])
+    print(len(block.to_json()), len(block.to_bytes()), block_from_bytes(block.to_bytes()).hash == block.hash)
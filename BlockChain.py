@@ -1,16 +1,28 @@
-from Block import Block,block_from_json
+from Block import Block,block_from_json,block_work,hash_meets_difficulty
 import time
+import struct
 from MerkleTree import MerkleTree
 import json
 
 class BlockChain:
-    def __init__(self):
-        self.chain = [self.create_genesis_block()]
-        self.height = 1
+    def __init__(self, store=None):
+        # store为BlockStore时区块持久化到磁盘，否则只保存在内存列表中
+        if store is None:
+            self.chain = [self.create_genesis_block()]
+        else:
+            if len(store) == 0:
+                store.append(self.create_genesis_block())
+            self.chain = store
+        self.height = len(self.chain)
         self.difficulty = 5
+        # 区块哈希 -> 高度（磁盘存储自带哈希索引，不需要这个字典）
+        self.block_heights = {block.hash: i for i, block in enumerate(self.chain)} if store is None else None
+        # 交易哈希 -> (区块高度, 叶子下标)，第一次查询时才建立，之后随区块增删维护
+        self.tx_index = None
 
     def create_genesis_block(self):
-        return Block(0, MerkleTree(["Genesis Block"]), "0", 0, timestamp=0)
+        # 创世区块保持旧版哈希，保证与旧节点的创世区块一致
+        return Block(0, MerkleTree(["Genesis Block"]), "0", 0, timestamp=0, version=0)
 
     def get_latest_block(self):
         return self.chain[-1]
@@ -18,15 +30,107 @@ class BlockChain:
     def add_block(self, data: list):
         previous_block = self.get_latest_block()
         new_block = Block(self.height, MerkleTree(data), previous_block.hash,0)
-        self.chain.append(new_block)
-        self.height += 1
+        self.append_block(new_block)
 
     def append_block(self,block:Block):
         self.chain.append(block)
+        self.index_block(self.height, block)
         self.height += 1
 
-    def is_chain_valid(self):
-        for i in range(1, len(self.chain)):
+    def pop_block(self):
+        """移除并返回链尾区块（链重组时使用）"""
+        block = self.chain[-1]
+        self.unindex_blocks(self.height - 1)
+        del self.chain[self.height - 1:]
+        self.height -= 1
+        return block
+
+    def index_block(self, height, block):
+        if self.block_heights is not None:
+            self.block_heights[block.hash] = height
+        if self.tx_index is not None:
+            for i, tx_hash in leaf_tx_hashes(block):
+                self.tx_index[tx_hash] = (height, i)
+
+    def unindex_blocks(self, height):
+        # 删除height及之后区块的索引（链重组时使用）
+        for h in range(height, len(self.chain)):
+            block = self.chain[h]
+            if self.block_heights is not None and self.block_heights.get(block.hash) == h:
+                del self.block_heights[block.hash]
+            if self.tx_index is not None:
+                for i, tx_hash in leaf_tx_hashes(block):
+                    if self.tx_index.get(tx_hash) == (h, i):
+                        del self.tx_index[tx_hash]
+
+    def height_of(self, block_hash):
+        """按区块哈希查找高度，找不到返回None"""
+        if self.block_heights is not None:
+            return self.block_heights.get(block_hash)
+        return self.chain.height_of(block_hash)
+
+    def get_block_by_hash(self, block_hash):
+        height = self.height_of(block_hash)
+        return None if height is None else self.chain[height]
+
+    def get_block_hash(self, height):
+        # 磁盘存储可以直接从索引读出哈希，不必解码区块
+        if isinstance(self.chain, list):
+            return self.chain[height].hash
+        return self.chain.block_hash(height)
+
+    def replace_chain(self, blockchain):
+        """用另一条链替换本链：保留相同的前缀，只改写分叉点之后的区块"""
+        fork = self.find_fork_point(blockchain)
+        self.unindex_blocks(fork)
+        del self.chain[fork:]
+        self.height = len(self.chain)
+        for height in range(fork, len(blockchain.chain)):
+            self.append_block(blockchain.chain[height])
+
+    def find_transaction(self, tx_hash):
+        """查找交易所在的位置，返回(区块高度, 叶子下标)，找不到返回None"""
+        if self.tx_index is None:
+            self.tx_index = {}
+            for height, block in enumerate(self.chain):
+                for i, leaf_tx_hash in leaf_tx_hashes(block):
+                    self.tx_index[leaf_tx_hash] = (height, i)
+        return self.tx_index.get(tx_hash)
+
+    def get_locator(self):
+        """区块定位器：从链尾往回取区块哈希，间隔逐渐加倍，最后是创世区块"""
+        locator = []
+        height = self.height - 1
+        step = 1
+        while height > 0:
+            locator.append(self.get_block_hash(height))
+            if len(locator) >= 10:
+                step *= 2
+            height -= step
+        locator.append(self.get_block_hash(0))
+        return locator
+
+    def locate(self, locator):
+        """返回定位器中第一个位于本链上的区块的高度，都不在时返回0（创世区块）"""
+        for block_hash in locator:
+            height = self.height_of(block_hash)
+            if height is not None:
+                return height
+        return 0
+
+    def find_fork_point(self, blockchain):
+        """返回另一条链与本链第一个不同区块的高度；在此之前的区块本链都已验证过，可以直接信任。
+
+        从较短链的末尾往回找，耗时与分叉深度成正比，而不是与链长成正比。
+        """
+        height = min(self.height, blockchain.height)
+        while height > 0 and self.height_of(blockchain.get_block_hash(height - 1)) != height - 1:
+            height -= 1
+        return height
+
+    def is_chain_valid(self, start=1):
+        # start之前的区块视为已验证，只检查之后的区块（以及它与前一个区块的链接）
+        for i in range(max(start, 1), len(self.chain)):
             current_block = self.chain[i]
             previous_block = self.chain[i - 1]
             if current_block.hash != current_block.calculate_hash():
@@ -39,27 +143,52 @@ class BlockChain:
                     False,
                     f"The previous hash of the {current_block.index} block is not equal to the hash of the {previous_block.index} block",
                 )
-            if not current_block.hash.startswith("0" * self.difficulty):
+            if not hash_meets_difficulty(current_block.hash, self.difficulty, current_block.version):
                 return (
                     False,
                     f"The hash of the {current_block.index} block does not start with {self.difficulty} zeros",
                 )
+            if not current_block.is_body_valid():
+                return (
+                    False,
+                    f"The merkle tree of the {current_block.index} block does not match its merkle root",
+                )
         return True
     
     def is_block_valid(self,block:Block):
         if block.index != self.height:
             return False
-        if not block.hash.startswith("0" * self.difficulty):
+        if block.previous_hash != self.get_block_hash(self.height - 1):
             return False
-        if block.previous_hash != self.chain[-1].hash:
-            return False
-        if block.hash != block.calculate_hash():
+        # 先检查区块头，通过后才解码区块体
+        return self.is_block_pow_valid(block) and block.is_body_valid()
+
+    def is_block_pow_valid(self, block: Block):
+        # 只检查区块自身的哈希和工作量证明，不要求它接在链尾（用于侧链区块）
+        # 字段格式错误（如非十六进制的哈希、越界的nonce）同样视为无效，而不是抛出异常
+        try:
+            if not hash_meets_difficulty(block.hash, self.difficulty, block.version):
+                return False
+            return block.hash == block.calculate_hash()
+        except (ValueError, TypeError, AttributeError, struct.error):
             return False
-        return True
+
+    def chain_work(self, height=None):
+        """前height个区块的累计工作量（难度固定，每个区块工作量相同）"""
+        return (self.height if height is None else height) * block_work(self.difficulty)
     
     def to_json(self):
         return json.dumps([block.to_json() for block in self.chain[1:]], ensure_ascii=False)
 
+    def iter_ndjson(self, start=1):
+        """逐行生成区块JSON（NDJSON，每行一个区块），整条链不会同时出现在内存中"""
+        for height in range(start, self.height):
+            yield self.chain[height].to_json() + "\n"
+
+    def save_ndjson(self, filename):
+        with open(filename, "w", encoding="utf-8") as f:
+            f.writelines(self.iter_ndjson())
+
     def draw_svg(self):
         # 设置基本参数
         block_width = 400  # 区块宽度
@@ -206,6 +335,36 @@ class BlockChain:
         with open(filename, "w") as f:
             f.write(svg_content)
 
+def leaf_tx_hashes(block):
+    """遍历区块中的交易叶子，返回(叶子下标, 交易哈希)"""
+    for i, leaf in enumerate(block.merkle_tree.leaves):
+        try:
+            tx_hash = json.loads(leaf.data).get("tx_hash")
+        except (ValueError, TypeError, AttributeError):
+            continue  # 跳过非交易数据
+        if tx_hash is not None:
+            yield i, tx_hash
+
+
+def iter_blocks_from_ndjson(lines):
+    """从NDJSON的行（文件对象、socket读取器或字符串列表）中逐个解码区块"""
+    for line in lines:
+        if line.strip():
+            yield block_from_json(line)
+
+
+def block_chain_from_ndjson(lines, blockchain=None):
+    """逐个验证并追加区块；导入到BlockStore支持的链时，内存占用与链长无关"""
+    blockchain = BlockChain() if blockchain is None else blockchain
+    for block in iter_blocks_from_ndjson(lines):
+        if blockchain.height_of(block.hash) == block.index:
+            continue  # 已经有的区块
+        if not blockchain.is_block_valid(block):
+            raise ValueError(f"Invalid block {block.index} in chain export")
+        blockchain.append_block(block)
+    return blockchain
+
+
 def block_chain_from_json(block_chain_json):
     block_chain_dict = json.loads(block_chain_json)
     block_chain = BlockChain()
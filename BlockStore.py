@@ -0,0 +1,273 @@
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+from Block import block_from_json
+from Codec import Reader, Writer
+from Transaction import UTXO
+
+INDEX_HEADER = struct.Struct("<Q")  # 索引中已写入的区块数
+INDEX_RECORD = struct.Struct("<QI32s")  # 区块在数据文件中的偏移、长度，以及区块哈希
+HASH_HEADER = struct.Struct("<Q")  # 哈希表中已占用的槽数
+HASH_SLOT = struct.Struct("<32sQ")  # 区块哈希, 高度+1（0表示空槽）
+INITIAL_CAPACITY = 1024
+CACHE_SIZE = 64  # 缓存最近访问的区块，避免反复解码链尾的区块
+UTXO_SNAPSHOT_INTERVAL = 100  # 每连接这么多个区块保存一次UTXO快照，重启时最多重放这么多个区块
+
+
+def open_mmap(filename, size):
+    # 打开（必要时创建并预分配）文件，并把整个文件映射到内存
+    if not os.path.exists(filename):
+        with open(filename, "wb") as f:
+            f.truncate(size)
+    f = open(filename, "r+b")
+    return f, mmap.mmap(f.fileno(), 0)
+
+
+class BlockStore:
+    """持久化区块存储：追加写入的区块数据文件，加上内存映射的高度索引和哈希索引。
+
+    打开时只读取索引头，耗时与链长无关；区块体在访问时才从数据文件读取并解码。
+    目录中还保存最近的UTXO快照，重启时从快照开始只重放之后的区块。
+    读取可以在blockchain_lock之外进行，数据文件、索引映射和缓存由self.lock保护。
+    """
+
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        data_filename = os.path.join(path, "blocks.dat")
+        open(data_filename, "ab").close()
+        self.data_file = open(data_filename, "r+b")
+        self.index_file, self.index = open_mmap(
+            os.path.join(path, "blocks.idx"), INDEX_HEADER.size + INITIAL_CAPACITY * INDEX_RECORD.size
+        )
+        self.hash_file, self.hash_index = open_mmap(
+            os.path.join(path, "blocks.hidx"), HASH_HEADER.size + INITIAL_CAPACITY * HASH_SLOT.size
+        )
+        self.count = INDEX_HEADER.unpack_from(self.index)[0]
+        self.cache = OrderedDict()
+        self.recover()
+
+    def recover(self):
+        # 上次写入中断时，丢弃数据文件中没有被索引记录的尾部，以及指向缺失数据的索引
+        data_size = self.data_file.seek(0, os.SEEK_END)
+        while self.count > 0 and self.record_end(self.count - 1) > data_size:
+            self.count -= 1
+        INDEX_HEADER.pack_into(self.index, 0, self.count)
+        self.data_end = self.record_end(self.count - 1) if self.count else 0
+        if data_size > self.data_end:
+            self.data_file.truncate(self.data_end)
+
+    def record(self, height):
+        return INDEX_RECORD.unpack_from(self.index, INDEX_HEADER.size + height * INDEX_RECORD.size)
+
+    def record_end(self, height):
+        offset, length, _ = self.record(height)
+        return offset + length
+
+    @property
+    def index_capacity(self):
+        return (len(self.index) - INDEX_HEADER.size) // INDEX_RECORD.size
+
+    @property
+    def hash_capacity(self):
+        return (len(self.hash_index) - HASH_HEADER.size) // HASH_SLOT.size
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for height in range(self.count):
+            yield self[height]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[height] for height in range(*key.indices(self.count))]
+        with self.lock:
+            height = key + self.count if key < 0 else key
+            if not 0 <= height < self.count:
+                raise IndexError("block height out of range")
+            if height in self.cache:
+                self.cache.move_to_end(height)
+                return self.cache[height]
+            offset, length, block_hash = self.record(height)
+            # pread不移动共享的文件位置
+            data = os.pread(self.data_file.fileno(), length, offset)
+        block = block_from_json(data.decode("utf-8"))
+        with self.lock:
+            # 解码期间这个高度可能已经被截断或换成了别的区块
+            if height < self.count and self.record(height)[2] == block_hash:
+                self.remember(height, block)
+        return block
+
+    def __delitem__(self, key):
+        # 只支持删除尾部，例如 del store[height:]
+        if not isinstance(key, slice) or key.stop is not None or key.step is not None:
+            raise TypeError("BlockStore only supports deleting a suffix")
+        self.truncate(key.indices(self.count)[0])
+
+    def remember(self, height, block):
+        self.cache[height] = block
+        self.cache.move_to_end(height)
+        while len(self.cache) > CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+    def block_hash(self, height):
+        # 直接从索引读取区块哈希，无需解码区块
+        return self.record(height)[2].hex()
+
+    def height_of(self, block_hash):
+        """按区块哈希查找高度，找不到返回None"""
+        try:
+            key = bytes.fromhex(block_hash)
+        except ValueError:
+            return None
+        capacity = self.hash_capacity
+        slot = int.from_bytes(key[:8], "little") % capacity
+        while True:
+            stored, height = HASH_SLOT.unpack_from(self.hash_index, HASH_HEADER.size + slot * HASH_SLOT.size)
+            if height == 0:
+                return None
+            if stored == key:
+                # 链被截断后哈希表里可能残留旧记录，需要和高度索引核对
+                height -= 1
+                if height < self.count and self.record(height)[2] == key:
+                    return height
+                return None
+            slot = (slot + 1) % capacity
+
+    def append(self, block):
+        data = block.to_json().encode("utf-8")
+        with self.lock:
+            self.append_data(block, data)
+
+    def append_data(self, block, data):
+        self.data_file.seek(self.data_end)
+        self.data_file.write(data)
+        self.data_file.flush()
+        if self.count == self.index_capacity:
+            self.index_file, self.index = self.grow(self.index_file, self.index, INDEX_HEADER.size + 2 * self.count * INDEX_RECORD.size)
+        key = bytes.fromhex(block.hash)
+        INDEX_RECORD.pack_into(self.index, INDEX_HEADER.size + self.count * INDEX_RECORD.size, self.data_end, len(data), key)
+        self.insert_hash(key, self.count)
+        self.remember(self.count, block)
+        self.count += 1
+        self.data_end += len(data)
+        INDEX_HEADER.pack_into(self.index, 0, self.count)  # 最后更新区块数，写入中断时不会指向不完整的记录
+        self.index.flush()
+
+    def insert_hash(self, key, height):
+        used = HASH_HEADER.unpack_from(self.hash_index)[0]
+        if (used + 1) * 2 > self.hash_capacity:
+            self.rebuild_hash_index(max(INITIAL_CAPACITY, 4 * (self.count + 1)))
+            used = HASH_HEADER.unpack_from(self.hash_index)[0]
+        capacity = self.hash_capacity
+        slot = int.from_bytes(key[:8], "little") % capacity
+        while True:
+            position = HASH_HEADER.size + slot * HASH_SLOT.size
+            stored, stored_height = HASH_SLOT.unpack_from(self.hash_index, position)
+            if stored_height == 0 or stored == key:
+                if stored_height == 0:
+                    HASH_HEADER.pack_into(self.hash_index, 0, used + 1)
+                HASH_SLOT.pack_into(self.hash_index, position, key, height + 1)
+                return
+            slot = (slot + 1) % capacity
+
+    def rebuild_hash_index(self, capacity):
+        # 扩容时只重新插入当前有效的区块，顺便清掉截断留下的旧记录
+        self.hash_index.close()
+        self.hash_file.truncate(0)
+        self.hash_file.truncate(HASH_HEADER.size + capacity * HASH_SLOT.size)
+        self.hash_index = mmap.mmap(self.hash_file.fileno(), 0)
+        for height in range(self.count):
+            self.insert_hash(self.record(height)[2], height)
+        self.hash_index.flush()
+
+    def grow(self, f, mapping, size):
+        mapping.close()
+        f.truncate(size)
+        return f, mmap.mmap(f.fileno(), 0)
+
+    def truncate(self, height):
+        """删除height及之后的区块"""
+        with self.lock:
+            self.truncate_data(height)
+
+    def truncate_data(self, height):
+        if height >= self.count:
+            return
+        self.count = height
+        INDEX_HEADER.pack_into(self.index, 0, self.count)
+        self.index.flush()
+        self.data_end = self.record_end(height - 1) if height else 0
+        self.data_file.truncate(self.data_end)
+        for cached in [h for h in self.cache if h >= height]:
+            del self.cache[cached]
+
+    def save_utxo_snapshot(self, utxo_pool, undo_logs):
+        """保存链尾的UTXO池和最近区块的回滚日志。先写临时文件再替换，写入中断时保留上一个快照"""
+        writer = Writer()
+        writer.varint(self.count)
+        writer.raw(self.record(self.count - 1)[2])
+        writer.varint(len(utxo_pool))
+        for utxo_key, utxo in utxo_pool.items():
+            writer.string(utxo_key)
+            utxo.write(writer)
+        writer.varint(len(undo_logs))
+        for block_hash, undo in undo_logs.items():
+            writer.string(block_hash)
+            writer.varint(len(undo))
+            for utxo_key, previous in undo:
+                writer.string(utxo_key)
+                writer.byte(previous is not None)
+                if previous is not None:
+                    previous.write(writer)
+        filename = os.path.join(self.path, "utxo.snapshot")
+        with open(filename + ".tmp", "wb") as f:
+            f.write(writer.getvalue())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(filename + ".tmp", filename)
+
+    def load_utxo_snapshot(self):
+        """读取UTXO快照，返回(快照对应的区块数, UTXO池, 回滚日志)。
+        没有快照、快照损坏，或者快照的链尾已经不在链上（链被重组或截断）时返回None
+        """
+        filename = os.path.join(self.path, "utxo.snapshot")
+        if not os.path.exists(filename):
+            return None
+        try:
+            with open(filename, "rb") as f:
+                reader = Reader(f.read())
+            count = reader.varint()
+            tip = reader.raw()
+            if not 0 < count <= self.count or self.record(count - 1)[2] != tip:
+                return None
+            utxo_pool = {}
+            for _ in range(reader.varint()):
+                utxo_key = reader.string()
+                utxo_pool[utxo_key] = UTXO.read(reader)
+            undo_logs = {}
+            for _ in range(reader.varint()):
+                block_hash = reader.string()
+                undo = []
+                for _ in range(reader.varint()):
+                    utxo_key = reader.string()
+                    undo.append((utxo_key, UTXO.read(reader) if reader.byte() else None))
+                undo_logs[block_hash] = undo
+            reader.end()
+        except (OSError, ValueError) as e:
+            print(f"Ignoring UTXO snapshot: {e}")
+            return None
+        return count, utxo_pool, undo_logs
+
+    def close(self):
+        self.index.flush()
+        self.hash_index.flush()
+        self.index.close()
+        self.hash_index.close()
+        self.index_file.close()
+        self.hash_file.close()
+        self.data_file.close()
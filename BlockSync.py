@@ -0,0 +1,153 @@
+import threading
+import time
+from collections import deque
+from Block import block_from_json, is_header_valid
+
+MAX_HEADERS = 2000  # 每条#HEADERS消息最多携带的区块头数
+BLOCKS_PER_REQUEST = 16  # 每次向一个节点请求的区块数
+SYNC_TIMEOUT = 10  # 请求超过这么多秒没有响应就改向其他节点请求
+
+
+def headers_well_formed(headers):
+    # 对方发来的区块头必须是字典列表，且用来链接和查找的字段类型正确
+    return isinstance(headers, list) and all(
+        isinstance(header, dict) and type(header.get('index')) is int
+        and isinstance(header.get('hash'), str) and isinstance(header.get('previous_hash'), str)
+        for header in headers
+    )
+
+
+class BlockSync:
+    """先同步区块头、再从所有相连节点并行下载区块体的同步器"""
+
+    def __init__(self, node):
+        self.node = node
+        self.lock = threading.Lock()
+        self.headers = deque()  # 已验证、等待区块体的区块头（按高度排列）
+        self.bodies = {}  # 已下载但还未连接的区块，格式: {区块哈希: 区块}
+        self.requests = {}  # 下载中的区块，格式: {区块哈希: (节点, 请求时间)}
+        self.bad_peers = set()  # 本轮同步中超时或发来无效数据的节点
+
+    def reset(self):
+        self.headers.clear()
+        self.bodies.clear()
+        self.requests.clear()
+        self.bad_peers.clear()
+
+    def handle_headers(self, addr, headers):
+        """验证一串区块头的链接关系和工作量证明，比本地链更优时安排下载区块体"""
+        if not headers:
+            return
+        if not headers_well_formed(headers):
+            print(f"Malformed headers from {addr}")
+            with self.lock:
+                self.bad_peers.add(addr)
+            return
+        blockchain = self.node.blockchain
+        with self.node.blockchain_lock, self.lock:
+            previous_hash = headers[0].get('previous_hash')
+            if self.headers and previous_hash == self.headers[-1]['hash']:
+                # 接着上一批区块头继续
+                pending = list(self.headers)
+                index = self.headers[-1]['index'] + 1
+            else:
+                parent = blockchain.height_of(previous_hash)
+                if parent is None:
+                    print(f"Headers from {addr} do not connect to our chain")
+                    return
+                pending = []
+                index = parent + 1
+            for header in headers:
+                if (header.get('index') != index or header.get('previous_hash') != previous_hash
+                        or not is_header_valid(header, blockchain.difficulty)):
+                    print(f"Invalid header {index} from {addr}")
+                    self.bad_peers.add(addr)
+                    return
+                previous_hash = header['hash']
+                index += 1
+            # 只有累计工作量超过本地链时才值得下载
+            if blockchain.chain_work(index) <= blockchain.chain_work():
+                return
+            pending += [header for header in headers if blockchain.height_of(header['hash']) is None]
+            self.headers = deque(pending)
+            wanted = {header['hash'] for header in self.headers}
+            self.bodies = {h: block for h, block in self.bodies.items() if h in wanted}
+            self.requests = {h: request for h, request in self.requests.items() if h in wanted}
+            locator = [previous_hash] + blockchain.get_locator()
+        print(f"Received {len(headers)} headers from {addr}, {len(self.headers)} blocks to download")
+        if len(headers) >= MAX_HEADERS:
+            # 对方可能还有更多区块头，从最后一个继续请求
+            self.node.send_headers_request(addr, locator)
+        self.schedule()
+
+    def schedule(self):
+        """把还没有下载的区块按批次轮流分配给各个节点"""
+        peers = [peer for peer in list(self.node.peers) if peer != self.node.node_ip]
+        with self.lock:
+            good_peers = [peer for peer in peers if peer not in self.bad_peers]
+            if not good_peers:
+                # 所有节点都出过问题时再给它们一次机会
+                self.bad_peers.clear()
+                good_peers = peers
+            if not good_peers:
+                return
+            now = time.time()
+            wanted = [header['hash'] for header in self.headers
+                      if header['hash'] not in self.bodies and header['hash'] not in self.requests]
+            batches = []
+            for i in range(0, len(wanted), BLOCKS_PER_REQUEST):
+                peer = good_peers[(i // BLOCKS_PER_REQUEST) % len(good_peers)]
+                batch = wanted[i:i + BLOCKS_PER_REQUEST]
+                for block_hash in batch:
+                    self.requests[block_hash] = (peer, now)
+                batches.append((peer, batch))
+        for peer, batch in batches:
+            self.node.send_blocks_request(peer, batch)
+
+    def handle_blocks(self, addr, payloads, decode=block_from_json):
+        """收到区块体（JSON或二进制编码，由decode解码）：核对它与区块头一致后暂存，再按高度顺序连接"""
+        for payload in payloads:
+            try:
+                block = decode(payload)
+            except (ValueError, KeyError, TypeError) as e:
+                print(f"Invalid block from {addr}: {e}")
+                self.bad_peers.add(addr)
+                continue
+            with self.lock:
+                if self.requests.pop(block.hash, None) is None:
+                    continue  # 没有请求过或已经收到
+                # 重新计算的哈希必须等于区块头中的哈希，否则区块体被篡改过
+                if not self.node.blockchain.is_block_pow_valid(block) or not block.is_body_valid():
+                    print(f"Block body from {addr} does not match its header")
+                    self.bad_peers.add(addr)
+                    continue
+                self.bodies[block.hash] = block
+        self.connect_ready()
+        self.schedule()
+
+    def connect_ready(self):
+        # 从最低的高度开始，连接所有已经下载好的连续区块
+        while True:
+            with self.lock:
+                if not self.headers or self.headers[0]['hash'] not in self.bodies:
+                    return
+                header = self.headers.popleft()
+                block = self.bodies.pop(header['hash'])
+            if not self.node.accept_block(block):
+                print(f"Block {block.index} failed validation, abandoning sync")
+                with self.lock:
+                    self.reset()
+                return
+
+    def check_timeouts(self):
+        """把超时的请求改派给其他节点，慢节点不会拖住整个同步"""
+        with self.lock:
+            now = time.time()
+            for block_hash, (peer, requested_at) in list(self.requests.items()):
+                if now - requested_at > SYNC_TIMEOUT:
+                    del self.requests[block_hash]
+                    self.bad_peers.add(peer)
+            if not self.headers:
+                self.bad_peers.clear()
+                return
+        self.schedule()
@@ -0,0 +1,197 @@
+import heapq
+from MerkleTree import MerkleNode, MerkleTree
+
+BLOCK_REWARD = 50  # 挖矿奖励，不含手续费
+MAX_BLOCK_SIZE = 1000000  # 区块中普通交易序列化后的总字节数上限（不含挖矿奖励交易）
+
+
+def outpoint_amount(utxo, utxo_pool, transactions):
+    """输入花费的金额：先查全局UTXO池，再查transactions中尚未上链的父交易的输出，找不到时返回None"""
+    utxo_key = f"{utxo.tx_hash}:{utxo.output_index}"
+    if utxo_key in utxo_pool:
+        return utxo_pool[utxo_key].amount
+    parent = transactions.get(utxo.tx_hash)
+    if parent is not None and 0 <= utxo.output_index < len(parent.outputs):
+        return parent.outputs[utxo.output_index].amount
+    return None
+
+
+def missing_outpoints(tx, utxo_pool, transactions):
+    """输入中在全局UTXO池和transactions的输出里都找不到的UTXO（格式: tx_hash:output_index）"""
+    return [
+        f"{utxo.tx_hash}:{utxo.output_index}" for utxo in tx.inputs
+        if outpoint_amount(utxo, utxo_pool, transactions) is None
+    ]
+
+
+def transaction_fee(tx, utxo_pool, transactions):
+    """手续费 = 输入总额 - 输出总额；输入找不到或输出超过输入时返回None"""
+    total_input = 0
+    for utxo in tx.inputs:
+        amount = outpoint_amount(utxo, utxo_pool, transactions)
+        if amount is None:
+            return None
+        total_input += amount
+    fee = total_input - sum(output.amount for output in tx.outputs)
+    return fee if fee >= 0 else None
+
+
+class TemplateEntry:
+    """模板中一笔已验证的交易：序列化后的叶子节点（含叶子哈希）、手续费和大小只在加入时计算一次"""
+
+    def __init__(self, tx, leaf, fee):
+        self.tx = tx
+        self.leaf = leaf  # MerkleNode，data为叶子数据，hash为叶子哈希
+        self.fee = fee
+        self.size = len(leaf.data)
+        self.fee_rate = fee / max(self.size, 1)
+
+
+class BlockTemplate:
+    """持续维护的区块模板：保存交易池中已验证的交易及其叶子，只处理发生变化的交易。
+
+    交易池有新交易时只序列化、检查新交易；交易离开交易池（确认、冲突或被移除）时只复查它的子交易；
+    链重组后UTXO可能消失，调用invalidate让下次更新时复查全部交易的输入。
+    选中的交易不变时，新的区块只替换默克尔树的第一个叶子（挖矿奖励交易）。不带锁，由调用者加锁。
+    """
+
+    def __init__(self, serialize, max_size=MAX_BLOCK_SIZE):
+        self.serialize = serialize  # 把交易转成默克尔叶子数据
+        self.max_size = max_size
+        self.entries = {}  # 格式: {tx_hash: TemplateEntry}，按加入交易池的先后排列
+        self.children = {}  # 格式: {父交易哈希: 花费它输出的模板内子交易哈希集合}
+        self.mempool_version = None  # 上次同步时交易池的版本
+        self.stale = True  # 需要复查全部交易的输入
+        self.reselect = True  # 模板内容变化后需要重新选择交易
+        self.selected = []  # 选中的交易哈希，按在区块中的顺序
+        self.fees = 0
+        self.merkle_tree = None  # 上次生成的默克尔树，选中的交易变化时清空
+
+    def invalidate(self):
+        self.stale = True
+
+    def update(self, transactions, version, utxo_pool):
+        """与交易池同步。transactions为交易池内容{tx_hash: 交易}，version为它的版本，
+        utxo_pool为全局UTXO池（调用者持有它的锁）。返回不可能上链的交易，由调用者移出交易池。
+        """
+        invalid = []
+        # 先清除标记，更新期间再次发生的链重组留到下一次更新处理
+        stale, self.stale = self.stale, False
+        if version == self.mempool_version and not stale:
+            return invalid
+        # 离开交易池的交易：删除后复查它的子交易（父交易被确认时子交易的输入已在UTXO池中）
+        recheck = set()
+        for tx_hash in [tx_hash for tx_hash in self.entries if tx_hash not in transactions]:
+            recheck |= self.remove(tx_hash)
+        if stale:
+            recheck = set(self.entries)
+        while recheck:
+            tx_hash = recheck.pop()
+            entry = self.entries.get(tx_hash)
+            if entry is not None and not self.inputs_available(entry.tx, utxo_pool):
+                invalid.append(entry.tx)
+                recheck |= self.remove(tx_hash)
+        # 新进入交易池的交易：父交易可能在同一批中排在后面，反复处理直到没有进展
+        pending = [tx for tx_hash, tx in transactions.items() if tx_hash not in self.entries]
+        while pending:
+            waiting = []
+            for tx in pending:
+                parents = {utxo.tx_hash for utxo in tx.inputs if utxo.tx_hash in transactions}
+                if any(parent not in self.entries for parent in parents):
+                    waiting.append(tx)
+                    continue
+                fee = transaction_fee(tx, utxo_pool, {h: self.entries[h].tx for h in parents})
+                if fee is None:
+                    invalid.append(tx)
+                    continue
+                self.add(tx, fee, parents)
+            if len(waiting) == len(pending):
+                invalid.extend(waiting)  # 父交易无效或缺失
+                break
+            pending = waiting
+        self.mempool_version = version
+        self.reselect = True
+        return invalid
+
+    def add(self, tx, fee, parents):
+        data = self.serialize(tx)
+        self.entries[tx.tx_hash] = TemplateEntry(tx, MerkleNode(data=data), fee)
+        for parent in parents:
+            self.children.setdefault(parent, set()).add(tx.tx_hash)
+
+    def remove(self, tx_hash):
+        # 删除交易，返回需要复查的子交易
+        entry = self.entries.pop(tx_hash)
+        for utxo in entry.tx.inputs:
+            siblings = self.children.get(utxo.tx_hash)
+            if siblings is not None:
+                siblings.discard(tx_hash)
+                if not siblings:
+                    del self.children[utxo.tx_hash]
+        return self.children.pop(tx_hash, set())
+
+    def inputs_available(self, tx, utxo_pool):
+        for utxo in tx.inputs:
+            if f"{utxo.tx_hash}:{utxo.output_index}" in utxo_pool:
+                continue
+            parent = self.entries.get(utxo.tx_hash)
+            if parent is None or not 0 <= utxo.output_index < len(parent.tx.outputs):
+                return False
+            self.children.setdefault(utxo.tx_hash, set()).add(tx.tx_hash)
+        return True
+
+    def select(self):
+        """按手续费率从高到低挑选交易，父交易总是排在子交易之前，总大小不超过max_size。
+        返回(选中的交易哈希列表, 手续费总额)；放不下的交易留在交易池中等下一个区块。
+        """
+        waiting = {}  # 交易哈希 -> 还没被选中的模板内父交易数
+        for tx_hash, entry in self.entries.items():
+            waiting[tx_hash] = len({utxo.tx_hash for utxo in entry.tx.inputs if utxo.tx_hash in self.entries})
+        # 只有父交易都已选中的交易才进堆；相同费率按进入交易池的先后
+        order = {tx_hash: i for i, tx_hash in enumerate(self.entries)}
+        heap = [(-self.entries[h].fee_rate, order[h], h) for h, count in waiting.items() if count == 0]
+        heapq.heapify(heap)
+        selected = []
+        total_size = 0
+        total_fee = 0
+        while heap:
+            _, _, tx_hash = heapq.heappop(heap)
+            entry = self.entries[tx_hash]
+            if total_size + entry.size > self.max_size:
+                continue  # 放不下，它的子交易也不会进堆
+            selected.append(tx_hash)
+            total_size += entry.size
+            total_fee += entry.fee
+            for child in self.children.get(tx_hash, ()):
+                waiting[child] -= 1
+                if waiting[child] == 0:
+                    heapq.heappush(heap, (-self.entries[child].fee_rate, order[child], child))
+        return selected, total_fee
+
+    def get_fees(self):
+        """选中交易的手续费总额，用来创建挖矿奖励交易"""
+        if self.reselect:
+            selected, self.fees = self.select()
+            if selected != self.selected:
+                self.selected = selected
+                self.merkle_tree = None
+            self.reselect = False
+        return self.fees
+
+    def transactions(self):
+        self.get_fees()
+        return [self.entries[tx_hash].tx for tx_hash in self.selected]
+
+    def get_merkle_tree(self, mining_reward):
+        """[挖矿奖励交易] + 选中交易的默克尔树。选中的交易没变时复制上一棵树并只替换第一个叶子，
+        否则用缓存的叶子节点重建内部节点，都不再序列化或哈希交易。
+        """
+        self.get_fees()
+        data = self.serialize(mining_reward)
+        if self.merkle_tree is None:
+            self.merkle_tree = MerkleTree.from_leaves([MerkleNode(data=data)] + [self.entries[h].leaf for h in self.selected])
+        elif self.merkle_tree.leaves[0].data != data:
+            # 上一棵树可能已经属于挖出的区块，不能原地修改
+            self.merkle_tree = self.merkle_tree.copy()
+            self.merkle_tree.replace(0, data)
+        return self.merkle_tree
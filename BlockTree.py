@@ -0,0 +1,75 @@
+from Block import block_work
+
+MAX_REORG_DEPTH = 100  # 最多保留这么深的侧链区块和UTXO回滚日志
+
+
+class BlockTree:
+    """区块树：主链保存在BlockChain中，这里保存竞争分支上的区块，并按累计工作量选择最优链"""
+
+    def __init__(self, blockchain):
+        self.blockchain = blockchain
+        self.side_blocks = {}  # 不在主链上的区块，格式: {区块哈希: 区块}
+        self.work = {}  # 侧链区块的累计工作量，格式: {区块哈希: 累计工作量}
+
+    def cumulative_work(self, block_hash):
+        """从创世区块到该区块的累计工作量，区块未知时返回None"""
+        height = self.blockchain.height_of(block_hash)
+        if height is not None:
+            return self.blockchain.chain_work(height + 1)
+        return self.work.get(block_hash)
+
+    def parent_height(self, block_hash):
+        height = self.blockchain.height_of(block_hash)
+        if height is not None:
+            return height
+        block = self.side_blocks.get(block_hash)
+        return None if block is None else block.index
+
+    def add_block(self, block):
+        """把区块加入侧链，返回它的累计工作量；父区块未知或高度不连续时返回None"""
+        if block.hash in self.side_blocks:
+            return self.work[block.hash]
+        parent_work = self.cumulative_work(block.previous_hash)
+        if parent_work is None or block.index != self.parent_height(block.previous_hash) + 1:
+            return None
+        self.side_blocks[block.hash] = block
+        self.work[block.hash] = parent_work + block_work(self.blockchain.difficulty)
+        self.prune()
+        return self.work[block.hash]
+
+    def remove_block(self, block_hash):
+        self.side_blocks.pop(block_hash, None)
+        self.work.pop(block_hash, None)
+
+    def remove_subtree(self, block_hash):
+        """删除侧链区块和它在侧链上的全部后代（例如无效区块之后的分支）"""
+        self.remove_block(block_hash)
+        self.remove_detached()
+
+    def remove_detached(self):
+        # 删除父区块既不在主链上也不在侧链中的区块；按高度从低到高处理，一次删掉整棵子树
+        for block in sorted(self.side_blocks.values(), key=lambda block: block.index):
+            parent = block.previous_hash
+            if parent not in self.side_blocks and self.blockchain.height_of(parent) is None:
+                self.remove_block(block.hash)
+
+    def branch(self, block_hash):
+        """从侧链区块回溯到主链，返回(分叉高度, 从分叉点开始依次连接的区块)；回溯不到主链时返回None"""
+        blocks = []
+        while block_hash in self.side_blocks and self.blockchain.height_of(block_hash) is None:
+            block = self.side_blocks[block_hash]
+            blocks.append(block)
+            block_hash = block.previous_hash
+        height = self.blockchain.height_of(block_hash)
+        if height is None:
+            return None
+        return height + 1, blocks[::-1]
+
+    def prune(self):
+        # 丢弃离主链末端太远、已经不可能被重组的侧链区块，以及它们的后代
+        min_index = self.blockchain.height - MAX_REORG_DEPTH
+        pruned = [h for h, block in self.side_blocks.items() if block.index < min_index]
+        for block_hash in pruned:
+            self.remove_block(block_hash)
+        if pruned:
+            self.remove_detached()
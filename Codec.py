@@ -0,0 +1,192 @@
+import struct
+
+CODEC_VERSION = 1  # 二进制编码格式的版本，写在每个编码结果的第一个字节
+CODEC_BINARY = "binary1"
+CODEC_JSON = "json"
+SUPPORTED_CODECS = [CODEC_BINARY, CODEC_JSON]  # 按优先顺序排列，与节点协商时使用
+
+DOUBLE = struct.Struct("<d")
+MAX_VARINT_BYTES = 10  # 变长整数最多10字节（70位），足够表示64位整数
+
+# 可选字段的类型标记
+TAG_NONE = 0
+TAG_HEX = 1  # 十六进制字符串，按原始字节保存
+TAG_STR = 2  # 其他字符串，按UTF-8保存
+TAG_INT = 3
+TAG_FLOAT = 4
+TAG_BYTES = 5
+
+
+class Writer:
+    """把各种字段依次写入一个bytearray"""
+
+    def __init__(self):
+        self.buffer = bytearray([CODEC_VERSION])
+
+    def byte(self, value):
+        self.buffer.append(value)
+
+    def varint(self, value):
+        # 无符号变长整数，每字节7位，最高位表示后面还有字节
+        if value >> (7 * MAX_VARINT_BYTES):
+            raise ValueError(f"Integer too large to encode: {value}")
+        while value >= 0x80:
+            self.buffer.append((value & 0x7F) | 0x80)
+            value >>= 7
+        self.buffer.append(value)
+
+    def raw(self, data):
+        self.varint(len(data))
+        self.buffer += data
+
+    def number(self, value):
+        # 保留int/float的区别，否则交易的JSON表示（和它的哈希）会变
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"Cannot encode number {value!r}")
+        if isinstance(value, float):
+            self.byte(TAG_FLOAT)
+            self.buffer += DOUBLE.pack(value)
+        else:
+            self.byte(TAG_INT)
+            self.varint(value * 2 if value >= 0 else -value * 2 - 1)  # zigzag
+
+    def optional_number(self, value):
+        if value is None:
+            self.byte(TAG_NONE)
+        else:
+            self.number(value)
+
+    def string(self, value, prefix=""):
+        """可选字符串；能无损还原的十六进制串（可带前缀，如地址的0x）按原始字节保存"""
+        if value is None:
+            self.byte(TAG_NONE)
+            return
+        if value.startswith(prefix):
+            try:
+                data = bytes.fromhex(value[len(prefix):])
+            except ValueError:
+                data = None
+            if data is not None and prefix + data.hex() == value:
+                self.byte(TAG_HEX)
+                self.raw(data)
+                return
+        self.byte(TAG_STR)
+        self.raw(value.encode("utf-8"))
+
+    def optional_bytes(self, value):
+        if value is None:
+            self.byte(TAG_NONE)
+        else:
+            self.byte(TAG_BYTES)
+            self.raw(value)
+
+    def getvalue(self):
+        return bytes(self.buffer)
+
+
+class Reader:
+    """按Writer写入的顺序读取字段，数据不完整或格式错误时抛出ValueError"""
+
+    def __init__(self, data):
+        self.data = bytes(data)
+        self.offset = 0
+        version = self.byte()
+        if version != CODEC_VERSION:
+            raise ValueError(f"Unsupported codec version {version}")
+
+    def byte(self):
+        try:
+            value = self.data[self.offset]
+        except IndexError:
+            raise ValueError("Truncated binary data")
+        self.offset += 1
+        return value
+
+    def varint(self):
+        value = self.byte()
+        if value < 0x80:
+            return value  # 绝大多数长度和计数只占一个字节
+        value &= 0x7F
+        for shift in range(7, 7 * MAX_VARINT_BYTES, 7):
+            byte = self.byte()
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return value
+        raise ValueError("Varint too long")
+
+    def raw(self):
+        length = self.varint()
+        end = self.offset + length
+        if end > len(self.data):
+            raise ValueError("Truncated binary data")
+        data = self.data[self.offset:end]
+        self.offset = end
+        return data
+
+    def optional_number(self):
+        tag = self.byte()
+        if tag == TAG_NONE:
+            return None
+        if tag == TAG_FLOAT:
+            end = self.offset + DOUBLE.size
+            if end > len(self.data):
+                raise ValueError("Truncated binary data")
+            value = DOUBLE.unpack_from(self.data, self.offset)[0]
+            self.offset = end
+            return value
+        if tag == TAG_INT:
+            value = self.varint()
+            return value >> 1 if value & 1 == 0 else -((value + 1) >> 1)
+        raise ValueError(f"Unexpected tag {tag} for number")
+
+    def number(self):
+        value = self.optional_number()
+        if value is None:
+            raise ValueError("Missing number")
+        return value
+
+    def string(self, prefix=""):
+        tag = self.byte()
+        if tag == TAG_NONE:
+            return None
+        if tag == TAG_HEX:
+            return prefix + self.raw().hex()
+        if tag == TAG_STR:
+            return self.raw().decode("utf-8")
+        raise ValueError(f"Unexpected tag {tag} for string")
+
+    def optional_bytes(self):
+        tag = self.byte()
+        if tag == TAG_NONE:
+            return None
+        if tag == TAG_BYTES:
+            return self.raw()
+        raise ValueError(f"Unexpected tag {tag} for bytes")
+
+    def end(self):
+        if self.offset != len(self.data):
+            raise ValueError("Trailing bytes after binary data")
+
+
+def encode_list(items):
+    # 多个已编码的对象拼成一条消息：个数 + 每个对象的长度和内容
+    writer = Writer()
+    writer.varint(len(items))
+    for item in items:
+        writer.raw(item)
+    return writer.getvalue()
+
+
+def decode_list(data):
+    reader = Reader(data)
+    items = [reader.raw() for _ in range(reader.varint())]
+    reader.end()
+    return items
+
+
+def choose_codec(codecs):
+    """在对方支持的编码中选出双方都支持的最优的一个"""
+    for codec in SUPPORTED_CODECS:
+        if codec in codecs:
+            return codec
+    return CODEC_JSON
@@ -0,0 +1,375 @@
+import queue
+import threading
+import time
+from collections import deque
+
+ADMISSION_BATCH = 64  # 每批最多取出这么多笔交易一起验证
+LATENCY_WINDOW = 1000  # 准入延迟统计最近这么多笔交易
+ADMISSION_QUEUE_SIZE = 10000  # 等待验证的交易最多排队这么多笔，队列满时丢弃新收到的交易
+
+
+MEMPOOL_MAX_SIZE = 5000000  # 交易池中交易序列化后的总字节数上限
+MEMPOOL_EXPIRY = 2 * 3600  # 交易在交易池中超过这么多秒仍未确认就移除
+MEMPOOL_LOW_WATER = 0.9  # 超过上限时驱逐到上限的这个比例，之后加入的交易在再次填满之前不用重新排序
+MAX_ORPHANS = 1000  # 孤儿池最多保存的交易数
+ORPHAN_EXPIRY = 20 * 60  # 孤儿交易等待父交易的最长秒数
+MAX_ORPHAN_SIZE = 100000  # 孤儿交易序列化后的最大字节数，更大的孤儿交易直接拒绝
+
+
+def outpoints(transaction):
+    # 交易花费的UTXO，键的格式与全局UTXO池相同: tx_hash:output_index
+    return [f"{utxo.tx_hash}:{utxo.output_index}" for utxo in transaction.inputs]
+
+
+class MempoolEntry:
+    def __init__(self, fee, size, added):
+        self.fee = fee  # 手续费
+        self.size = size  # 序列化后的字节数
+        self.added = added  # 进入交易池的时间
+
+
+class Mempool:
+    """按交易哈希索引的交易池，同时记录每个UTXO被池中哪笔交易花费。
+
+    重复的交易和与池中交易花费同一UTXO的交易在加入时直接拒绝；
+    确认或移除一笔交易只需处理它自己的输入，与交易池大小无关。
+    总大小超过上限时按手续费率驱逐到低水位，停留太久的交易过期移除；移除一笔交易时它在池中的后代一起移除。
+    驱逐需要给全部交易排序，低水位让排序只在交易池每次重新填满时发生一次；
+    交易池已满时，手续费率不高于上次被驱逐交易的新交易不用排序就直接拒绝。
+    不带锁，由调用者加锁。
+    """
+
+    def __init__(self, max_size=MEMPOOL_MAX_SIZE, expiry=MEMPOOL_EXPIRY, low_water=MEMPOOL_LOW_WATER):
+        self.max_size = max_size
+        self.low_water = int(max_size * low_water)  # 驱逐后的目标总大小
+        self.expiry = expiry
+        self.transactions = {}  # 格式: {tx_hash: 交易}，按加入顺序排列
+        self.entries = {}  # 格式: {tx_hash: MempoolEntry}
+        self.spent = {}  # 格式: {tx_hash:output_index: 花费它的交易哈希}
+        self.children = {}  # 格式: {父交易哈希: 花费它输出的池内子交易哈希集合}
+        self.total_size = 0
+        self.version = 0  # 每次加入或移除交易时加一，区块模板据此判断是否需要更新
+        self.min_fee_rate = 0  # 被驱逐交易组的最高手续费率；交易池已满时不高于它的新交易直接拒绝
+        self.evicted = 0  # 因交易池已满被驱逐的交易数
+        self.expired = 0  # 过期移除的交易数
+        self.conflicted = 0  # 与新区块中的交易冲突而移除的交易数
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self.transactions
+
+    def __iter__(self):
+        return iter(self.transactions.values())
+
+    def get(self, tx_hash):
+        return self.transactions.get(tx_hash)
+
+    def conflicts(self, transaction):
+        """返回池中与transaction花费同一UTXO的交易哈希"""
+        return {self.spent[key] for key in outpoints(transaction) if key in self.spent}
+
+    def add(self, transaction, fee, size, now=None):
+        """加入交易，已经在池中、与池中交易双花，或交易池已满而它的手续费率最低时返回False"""
+        tx_hash = transaction.tx_hash
+        if tx_hash in self.transactions:
+            return False
+        keys = outpoints(transaction)
+        if len(set(keys)) != len(keys) or any(key in self.spent for key in keys):
+            return False
+        if self.total_size + size > self.max_size and fee / max(size, 1) <= self.min_fee_rate:
+            return False  # 交易池已满，它不会比已经被驱逐的交易更值得保留
+        for parent in {utxo.tx_hash for utxo in transaction.inputs if utxo.tx_hash in self.transactions}:
+            self.children.setdefault(parent, set()).add(tx_hash)
+        self.transactions[tx_hash] = transaction
+        self.entries[tx_hash] = MempoolEntry(fee, size, time.time() if now is None else now)
+        self.total_size += size
+        for key in keys:
+            self.spent[key] = tx_hash
+        self.version += 1
+        if self.total_size > self.max_size:
+            # 排好序的驱逐计划一直驱逐到低水位；只有回到上限以内所必需的那部分包含新交易时才拒绝它
+            needed = self.total_size - self.max_size
+            freed = 0
+            packages = []
+            for package in self.eviction_packages(self.total_size - self.low_water):
+                if tx_hash in package:
+                    if freed < needed:
+                        # 新交易自己就在要驱逐的交易中：直接拒绝，不驱逐池中的其他交易；
+                        # 同样记下它的手续费率，费率更低的新交易以后不用排序就能拒绝
+                        self.min_fee_rate = max(self.min_fee_rate, fee / max(size, 1))
+                        self.remove(tx_hash)
+                        return False
+                    break  # 已经回到上限以内，新交易和排在它后面的交易保留
+                packages.append(package)
+                freed += sum(self.entries[h].size for h in package)
+            self.evict(packages)
+        return True
+
+    def remove(self, tx_hash):
+        """移除交易并释放它花费的UTXO，返回被移除的交易，不在池中时返回None。池中的子交易保留"""
+        transaction = self.transactions.pop(tx_hash, None)
+        if transaction is not None:
+            self.total_size -= self.entries.pop(tx_hash).size
+            for utxo in transaction.inputs:
+                key = f"{utxo.tx_hash}:{utxo.output_index}"
+                if self.spent.get(key) == tx_hash:
+                    del self.spent[key]
+                siblings = self.children.get(utxo.tx_hash)
+                if siblings is not None:
+                    siblings.discard(tx_hash)
+                    if not siblings:
+                        del self.children[utxo.tx_hash]
+            self.children.pop(tx_hash, None)
+            self.version += 1
+        return transaction
+
+    def descendants(self, tx_hash):
+        """交易本身和它在池中的全部后代"""
+        package = {tx_hash}
+        stack = [tx_hash]
+        while stack:
+            for child in self.children.get(stack.pop(), ()):
+                if child not in package:
+                    package.add(child)
+                    stack.append(child)
+        return package
+
+    def remove_package(self, tx_hash):
+        # 移除交易和它的全部后代（后代花费的输出不会再出现），返回被移除的交易
+        if tx_hash not in self.transactions:
+            return []
+        return [self.remove(h) for h in self.descendants(tx_hash)]
+
+    def remove_confirmed(self, transactions):
+        """区块确认了transactions：移除它们，以及池中花费了同一UTXO的冲突交易和冲突交易的后代。返回被移除的冲突交易"""
+        removed = []
+        for transaction in transactions:
+            self.remove(transaction.tx_hash)
+            for tx_hash in self.conflicts(transaction):
+                removed.extend(self.remove_package(tx_hash))
+        self.conflicted += len(removed)
+        self.drained()
+        return removed
+
+    def drained(self):
+        # 交易被确认或过期后总大小回到低水位以下，上次驱逐时的手续费率门槛不再有意义
+        if self.total_size < self.low_water:
+            self.min_fee_rate = 0
+
+    def eviction_packages(self, excess):
+        """按"交易+全部后代"整体的手续费率从低到高，选出释放至少excess字节所需驱逐的交易组，不修改交易池。
+        子交易的手续费计入父交易，高手续费的子交易可以带着低手续费的父交易留下。
+        """
+        scores = []
+        for i, tx_hash in enumerate(self.transactions):
+            package = self.descendants(tx_hash)
+            fee = sum(self.entries[h].fee for h in package)
+            size = sum(self.entries[h].size for h in package)
+            scores.append((fee / max(size, 1), -i, tx_hash))  # 费率相同时先驱逐较新的交易
+        scores.sort()
+        packages = []
+        planned = set()
+        freed = 0
+        for _, _, tx_hash in scores:
+            if freed >= excess:
+                break
+            if tx_hash in planned:
+                continue  # 已经作为前面交易的后代被选中
+            package = self.descendants(tx_hash) - planned
+            planned |= package
+            freed += sum(self.entries[h].size for h in package)
+            packages.append(package)
+        return packages
+
+    def evict(self, packages=None):
+        """驱逐交易直到总大小不超过低水位，返回被驱逐的交易。
+        记下被驱逐交易组的最高手续费率，交易池再满时更低的新交易直接拒绝
+        """
+        if packages is None:
+            packages = self.eviction_packages(self.total_size - self.low_water)
+        removed = []
+        for package in packages:
+            fee = sum(self.entries[h].fee for h in package)
+            size = sum(self.entries[h].size for h in package)
+            self.min_fee_rate = max(self.min_fee_rate, fee / max(size, 1))
+            removed.extend(self.remove(h) for h in package)
+        self.evicted += len(removed)
+        return removed
+
+    def expire(self, now=None):
+        """移除停留超过expiry秒的交易及其后代。交易按加入顺序排列，只需从最早的开始检查"""
+        cutoff = (time.time() if now is None else now) - self.expiry
+        removed = []
+        while self.transactions:
+            tx_hash = next(iter(self.transactions))
+            if self.entries[tx_hash].added > cutoff:
+                break
+            removed.extend(self.remove_package(tx_hash))
+        self.expired += len(removed)
+        self.drained()
+        return removed
+
+    def stats(self):
+        return {
+            "count": len(self.transactions),
+            "size": self.total_size,
+            "evicted": self.evicted,
+            "expired": self.expired,
+            "conflicted": self.conflicted,
+            "min_fee_rate": self.min_fee_rate,
+        }
+
+
+class OrphanPool:
+    """父交易还没到的交易（孤儿交易），按缺失的UTXO索引。
+
+    父交易进入交易池或在区块中上链、产生了这些UTXO时，等待它们的孤儿交易被取出重新尝试加入交易池；
+    签名在进入孤儿池之前已经验证过，不再重复验证。不带锁，由调用者加锁。
+    """
+
+    def __init__(self, max_count=MAX_ORPHANS, expiry=ORPHAN_EXPIRY, max_size=MAX_ORPHAN_SIZE):
+        self.max_count = max_count
+        self.expiry = expiry
+        self.max_size = max_size
+        self.orphans = {}  # 格式: {tx_hash: (交易, 缺失的UTXO列表, 加入时间)}，按加入顺序排列
+        self.waiting = {}  # 格式: {缺失的UTXO: 等待它的孤儿交易哈希集合}
+        self.released = 0  # 等到父交易后取出的交易数
+        self.evicted = 0  # 孤儿池满时丢弃的交易数
+        self.expired = 0  # 等待太久被丢弃的交易数
+
+    def __len__(self):
+        return len(self.orphans)
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self.orphans
+
+    def add(self, transaction, missing, size, now=None):
+        """保存孤儿交易，missing为它缺失的UTXO（格式: tx_hash:output_index），size为序列化后的字节数。
+        已经在池中或超过max_size时返回False
+        """
+        tx_hash = transaction.tx_hash
+        if tx_hash in self.orphans or size > self.max_size:
+            return False
+        # 孤儿池满时丢弃最早的孤儿交易
+        while len(self.orphans) >= self.max_count:
+            self.remove(next(iter(self.orphans)))
+            self.evicted += 1
+        self.orphans[tx_hash] = (transaction, missing, time.time() if now is None else now)
+        for key in missing:
+            self.waiting.setdefault(key, set()).add(tx_hash)
+        return True
+
+    def remove(self, tx_hash):
+        entry = self.orphans.pop(tx_hash, None)
+        if entry is None:
+            return None
+        for key in entry[1]:
+            waiting = self.waiting.get(key)
+            if waiting is not None:
+                waiting.discard(tx_hash)
+                if not waiting:
+                    del self.waiting[key]
+        return entry[0]
+
+    def release(self, transaction):
+        """transaction的输出已经可以花费：取出等待这些输出的孤儿交易（按加入孤儿池的先后）"""
+        tx_hashes = set()
+        for i in range(len(transaction.outputs)):
+            tx_hashes |= self.waiting.pop(f"{transaction.tx_hash}:{i}", set())
+        ordered = [tx_hash for tx_hash in self.orphans if tx_hash in tx_hashes] if tx_hashes else []
+        released = [self.remove(tx_hash) for tx_hash in ordered]
+        self.released += len(released)
+        return released
+
+    def expire(self, now=None):
+        """丢弃等待超过expiry秒的孤儿交易"""
+        cutoff = (time.time() if now is None else now) - self.expiry
+        removed = []
+        while self.orphans:
+            tx_hash = next(iter(self.orphans))
+            if self.orphans[tx_hash][2] > cutoff:
+                break
+            removed.append(self.remove(tx_hash))
+        self.expired += len(removed)
+        return removed
+
+    def stats(self):
+        return {"count": len(self.orphans), "released": self.released, "evicted": self.evicted, "expired": self.expired}
+
+
+class TransactionAdmission:
+    """交易准入流水线：接收连接的线程只把交易放进队列，后台线程批量取出，
+    并行验证签名后再放入交易池，大量交易涌入时不会拖住区块的转发。
+    """
+
+    def __init__(self, verifier, admit, batch_size=ADMISSION_BATCH, queue_size=ADMISSION_QUEUE_SIZE):
+        self.verifier = verifier  # SignatureVerifier，按批并行验证签名
+        self.admit = admit  # 把签名有效的交易放入交易池，返回是否真的加入
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_size)  # 有界队列，验证跟不上时内存不会无限增长
+        self.latencies = deque(maxlen=LATENCY_WINDOW)  # 从收到到处理完成的秒数
+        self.admitted = 0
+        self.rejected = 0
+        self.dropped = 0  # 队列已满被丢弃的交易数
+        self.lock = threading.Lock()  # 保护计数和延迟窗口，stats在挖矿线程中读取
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, transaction):
+        """把交易放进队列；队列已满时丢弃它并返回False，接收连接的线程不会因此阻塞"""
+        try:
+            self.queue.put_nowait((transaction, time.time()))
+            return True
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return False
+
+    def drain(self):
+        # 阻塞等待第一笔交易，再把已经排队的交易一起取出
+        batch = [self.queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.drain()
+            try:
+                self.process(batch)
+            except Exception as e:
+                print(f"Error admitting transactions: {e}")
+
+    def process(self, batch):
+        results = self.verifier.verify_each([transaction for transaction, _ in batch])
+        for (transaction, received), valid in zip(batch, results):
+            if not valid:
+                print(f"Invalid transaction signature: {transaction.tx_hash}")
+            # admit会获取交易池的锁，不能在self.lock内调用
+            admitted = valid and self.admit(transaction)
+            with self.lock:
+                if admitted:
+                    self.admitted += 1
+                else:
+                    self.rejected += 1
+                self.latencies.append(time.time() - received)
+
+    def stats(self):
+        with self.lock:
+            latencies = list(self.latencies)
+            admitted, rejected, dropped = self.admitted, self.rejected, self.dropped
+        return {
+            "queue_depth": self.queue.qsize(),
+            "admitted": admitted,
+            "rejected": rejected,
+            "dropped": dropped,
+            "latency_avg": sum(latencies) / len(latencies) if latencies else 0.0,
+            "latency_max": max(latencies, default=0.0),
+        }
@@ -1,5 +1,7 @@
 import hashlib
 import json
+from binascii import hexlify
+from collections import namedtuple
 class MerkleNode:
     def __init__(self, left=None, right=None, data=None):
         self.left = left
@@ -31,21 +33,28 @@ class MerkleTree:
         self.leaves = [MerkleNode(data=d) for d in data]
         self.root = self.build_tree(self.leaves)
 
+    @classmethod
+    def from_leaves(cls, leaves):
+        """用已经算好哈希的叶子节点建树（如区块模板缓存的叶子），不再重新哈希叶子数据"""
+        tree = cls.__new__(cls)
+        tree.leaves = list(leaves)
+        tree.root = tree.build_tree(tree.leaves)
+        return tree
+
+    def copy(self):
+        # 节点建好后不再修改（replace/remove都生成新节点），复制各层的列表即可
+        tree = MerkleTree.__new__(MerkleTree)
+        tree.leaves = list(self.leaves)
+        tree.levels = [tree.leaves] + [list(nodes) for nodes in self.levels[1:]]
+        tree.root = self.root
+        return tree
+
+    def to_dict(self):
+        # 只序列化有序的叶子数据，内部节点在反序列化时重新计算
+        return {'leaves': [leaf.data for leaf in self.leaves]}
+
     def to_json(self):
-        def node_to_dict(node):
-            if not node:
-                return None
-            return {
-                'left': node_to_dict(node.left),
-                'right': node_to_dict(node.right),
-                'data': node.data,
-                'hash': node.hash
-            }
-        
-        tree_dict = {
-            'root': node_to_dict(self.root)
-        }
-        return json.dumps(tree_dict, ensure_ascii=False)
+        return json.dumps(self.to_dict(), ensure_ascii=False)
 
     def __str__(self):
         def print_node(node, level=0):
@@ -63,9 +72,10 @@ class MerkleTree:
         return "\n".join(print_node(self.root))
 
     def get_root_hash(self):
-        return self.root.hash
+        return self.root.hash if self.root else None
 
     def build_tree(self, nodes):
+        self.levels = [nodes]  # 按层保存节点，用于生成包含证明
         while len(nodes) > 1:
             temp_nodes = []
             for i in range(0, len(nodes), 2):
@@ -74,7 +84,69 @@ class MerkleTree:
                 parent = MerkleNode(left=left, right=right)
                 temp_nodes.append(parent)
             nodes = temp_nodes
+            self.levels.append(nodes)
         return nodes[0] if nodes else None
+
+    def append(self, data):
+        """追加叶子，只重算新叶子到根路径上的节点"""
+        self.leaves.append(MerkleNode(data=data))
+        self.rehash(len(self.leaves) - 1, len(self.leaves))
+
+    def replace(self, index, data):
+        """替换叶子，只重算该叶子到根路径上的节点"""
+        self.leaves[index] = MerkleNode(data=data)
+        self.rehash(index, index + 1)
+
+    def remove(self, index):
+        """删除叶子；后面的叶子会前移，所以要重算index之后的部分，删除最后一个叶子只需O(log n)"""
+        del self.leaves[index]
+        self.rehash(index, len(self.leaves))
+
+    def rehash(self, start, stop):
+        # 叶子[start, stop)发生变化后逐层向上重算父节点，规则与build_tree相同（奇数个时复制最后一个）
+        nodes = self.levels[0] = self.leaves
+        level = 0
+        while len(nodes) > 1:
+            count = (len(nodes) + 1) // 2
+            if level + 1 == len(self.levels):
+                self.levels.append([])
+            parents = self.levels[level + 1]
+            del parents[count:]
+            start, stop = start // 2, min((stop + 1) // 2, count)
+            for i in range(start, stop):
+                left = nodes[2 * i]
+                right = nodes[2 * i + 1] if 2 * i + 1 < len(nodes) else left
+                parent = MerkleNode(left=left, right=right)
+                if i < len(parents):
+                    parents[i] = parent
+                else:
+                    parents.append(parent)
+            nodes = parents
+            level += 1
+        del self.levels[level + 1:]
+        self.root = nodes[0] if nodes else None
+
+    def leaf_index(self, key):
+        # key可以是叶子下标，也可以是叶子的哈希
+        if isinstance(key, int):
+            return key if 0 <= key < len(self.leaves) else None
+        for i, leaf in enumerate(self.leaves):
+            if leaf.hash == key:
+                return i
+        return None
+
+    def get_proof(self, key):
+        """生成叶子的包含证明：从叶子到根每一层的兄弟节点哈希"""
+        index = self.leaf_index(key)
+        if index is None:
+            return None
+        siblings = []
+        i = index
+        for nodes in self.levels[:-1]:
+            sibling = i + 1 if i % 2 == 0 else i - 1
+            siblings.append(nodes[sibling].hash if sibling < len(nodes) else nodes[i].hash)
+            i //= 2
+        return {'index': index, 'leaf_count': len(self.leaves), 'leaf_hash': self.leaves[index].hash, 'siblings': siblings}
     
     def save_svg(self,filename):
         # 设置基本参数
@@ -149,35 +221,220 @@ class MerkleTree:
         # 将SVG内容写入文件
         with open(filename, 'w') as f:
             f.write('\n'.join(svg))
-        
-def merkle_tree_from_json(json_data):
-    def dict_to_node(node_dict):
-        if not node_dict:
+
+
+HASH_SIZE = 32  # sha256原始摘要长度
+
+MerkleLeaf = namedtuple("MerkleLeaf", ["data", "hash"])  # FlatMerkleTree对外提供的叶子视图
+
+
+def hash_leaf(data):
+    return hashlib.sha256(str(data).encode("utf-8")).digest()
+
+
+def hash_pair(left, right):
+    # 与MerkleNode保持一致：对两个子节点十六进制哈希的拼接再做sha256，这样两种实现的根哈希相同
+    return hashlib.sha256(hexlify(left) + hexlify(right)).digest()
+
+
+class FlatMerkleTree:
+    """数组实现的Merkle树：每层的原始32字节摘要连续存放在一个bytearray中，按下标计算位置"""
+
+    def __init__(self, data):
+        self.data = list(data)
+        self.levels = [bytearray(b"".join(hash_leaf(d) for d in self.data))]
+        self.build_tree()
+
+    def build_tree(self):
+        # 自底向上逐层计算，奇数个节点时复制最后一个节点（与MerkleTree.build_tree相同）
+        del self.levels[1:]
+        level = self.levels[0]
+        while len(level) > HASH_SIZE:
+            parent = bytearray()
+            count = len(level) // HASH_SIZE
+            for i in range(0, count, 2):
+                left = level[i * HASH_SIZE:(i + 1) * HASH_SIZE]
+                right = level[(i + 1) * HASH_SIZE:(i + 2) * HASH_SIZE] if i + 1 < count else left
+                parent += hash_pair(left, right)
+            self.levels.append(parent)
+            level = parent
+
+    def append(self, data):
+        """追加叶子，只重算新叶子到根路径上的节点"""
+        self.data.append(data)
+        self.levels[0] += hash_leaf(data)
+        self.rehash(len(self.data) - 1, len(self.data))
+
+    def replace(self, index, data):
+        """替换叶子，只重算该叶子到根路径上的节点"""
+        self.data[index] = data
+        self.levels[0][index * HASH_SIZE:(index + 1) * HASH_SIZE] = hash_leaf(data)
+        self.rehash(index, index + 1)
+
+    def remove(self, index):
+        """删除叶子；后面的叶子会前移，所以要重算index之后的部分，删除最后一个叶子只需O(log n)"""
+        del self.data[index]
+        del self.levels[0][index * HASH_SIZE:(index + 1) * HASH_SIZE]
+        self.rehash(index, len(self.data))
+
+    def rehash(self, start, stop):
+        # 叶子[start, stop)发生变化后逐层向上重算父节点，规则与build_tree相同（奇数个时复制最后一个）
+        level = 0
+        size = len(self.data)
+        while size > 1:
+            nodes = self.levels[level]
+            count = (size + 1) // 2
+            if level + 1 == len(self.levels):
+                self.levels.append(bytearray())
+            parents = self.levels[level + 1]
+            del parents[count * HASH_SIZE:]
+            start, stop = start // 2, min((stop + 1) // 2, count)
+            for i in range(start, stop):
+                left = nodes[2 * i * HASH_SIZE:(2 * i + 1) * HASH_SIZE]
+                right = nodes[(2 * i + 1) * HASH_SIZE:(2 * i + 2) * HASH_SIZE] if 2 * i + 1 < size else left
+                parents[i * HASH_SIZE:(i + 1) * HASH_SIZE] = hash_pair(left, right)
+            size = count
+            level += 1
+        del self.levels[level + 1:]
+
+    def get_node(self, level, index):
+        return bytes(self.levels[level][index * HASH_SIZE:(index + 1) * HASH_SIZE])
+
+    @property
+    def leaves(self):
+        return [MerkleLeaf(d, self.get_node(0, i).hex()) for i, d in enumerate(self.data)]
+
+    def leaf_index(self, key):
+        # key可以是叶子下标，也可以是叶子的哈希
+        if isinstance(key, int):
+            return key if 0 <= key < len(self.data) else None
+        leaf = bytes.fromhex(key)
+        level = self.levels[0]
+        for i in range(len(self.data)):
+            if level[i * HASH_SIZE:(i + 1) * HASH_SIZE] == leaf:
+                return i
+        return None
+
+    def get_proof(self, key):
+        """生成叶子的包含证明：从叶子到根每一层的兄弟节点哈希"""
+        index = self.leaf_index(key)
+        if index is None:
             return None
-        node = MerkleNode(
-            left=dict_to_node(node_dict['left']),
-            right=dict_to_node(node_dict['right']),
-            data=node_dict['data']
-        )
-        node.hash = node_dict['hash']
-        return node
-    
-    data = json.loads(json_data)
-    tree = MerkleTree([])  # 初始化一个空的 MerkleTree
-    tree.root = dict_to_node(data['root'])
-    
-    # 初始化 leaves
-    def collect_leaves(node):
-        if not node:
-            return []
-        if not node.left and not node.right:
-            return [node]
-        return collect_leaves(node.left) + collect_leaves(node.right)
-    
-    tree.leaves = collect_leaves(tree.root)
-    
+        siblings = []
+        i = index
+        for level in range(len(self.levels) - 1):
+            sibling = i + 1 if i % 2 == 0 else i - 1
+            if sibling >= len(self.levels[level]) // HASH_SIZE:
+                sibling = i
+            siblings.append(self.get_node(level, sibling).hex())
+            i //= 2
+        return {'index': index, 'leaf_count': len(self.data), 'leaf_hash': self.get_node(0, index).hex(), 'siblings': siblings}
+
+    def get_root_hash(self):
+        if not self.data:
+            return None
+        return self.get_node(len(self.levels) - 1, 0).hex()
+
+    def to_dict(self):
+        # 与MerkleTree.to_dict格式相同，只序列化有序的叶子数据
+        return {'leaves': self.data}
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), ensure_ascii=False)
+
+    def __str__(self):
+        lines = []
+        for level in reversed(range(len(self.levels))):
+            count = len(self.levels[level]) // HASH_SIZE
+            lines.append(f"Level {level}: " + " ".join(self.get_node(level, i).hex()[:8] for i in range(count)))
+        return "\n".join(lines)
+
+
+def legacy_leaf_data(root_dict):
+    """从嵌套格式中取出原始叶子数据。
+    旧格式在奇数层复制最右节点补齐，所以嵌套结构总是满二叉树，最底层的前n个节点就是原始叶子。
+    n的范围由树高决定，每层的节点数由下一层向上取整得到，只有节点数为奇数的层最右端才是复制的节点；
+    取补齐位置与左兄弟哈希相同的最小n（更多的叶子会得到同一个根哈希，只能是重复的交易）。
+    """
+    if not root_dict:
+        return []
+    level = [root_dict]
+    while level[0]['left'] is not None:
+        level = [child for node in level for child in (node['left'], node['right'])]
+    data = [node['data'] for node in level]
+    # 按最底层重新计算满二叉树每层的哈希，不使用序列化数据中的hash字段
+    levels = MerkleTree(data).levels
+    for count in range(len(data) // 2 + 1, len(data) + 1):
+        if legacy_padding_matches(levels, count):
+            return data[:count]
+    return data
+
+
+def legacy_padding_matches(levels, count):
+    # 有count个原始叶子时，每个奇数层补齐的位置都应是左兄弟的复制
+    for nodes in levels[:-1]:
+        if count % 2 == 1 and nodes[count].hash != nodes[count - 1].hash:
+            return False
+        count = (count + 1) // 2
+    return True
+
+
+def verify_merkle_proof(proof, merkle_root):
+    """只用证明和区块头中的merkle_root验证叶子是否在树中（SPV验证）。
+
+    奇数层补齐时复制的节点会和原节点算出同一个根，所以同时检查下标在叶子数以内、
+    每层只有最右的奇数位置才能以自己为兄弟，并且右侧节点的左兄弟不能与它相同。
+    """
+    try:
+        node = bytes.fromhex(proof['leaf_hash'])
+        index, count = proof['index'], proof['leaf_count']
+        if not isinstance(index, int) or not isinstance(count, int) or not 0 <= index < count:
+            return False
+        for sibling in proof['siblings']:
+            if count <= 1:
+                return False  # 证明比树高还长
+            sibling = bytes.fromhex(sibling)
+            if index % 2 == 1:
+                if sibling == node:
+                    return False  # 补齐复制出来的节点
+                node = hash_pair(sibling, node)
+            else:
+                if (sibling == node) != (index == count - 1):
+                    return False  # 只有奇数层的最后一个节点和自己配对
+                node = hash_pair(node, sibling)
+            index //= 2
+            count = (count + 1) // 2
+    except (KeyError, TypeError, ValueError):
+        return False
+    return count == 1 and node.hex() == merkle_root
+
+
+def tree_leaf_data(data, merkle_root=None):
+    """从序列化数据中取出有序叶子，返回(叶子列表, 期望的根哈希)；兼容旧的嵌套格式"""
+    if 'leaves' in data:
+        return data['leaves'], merkle_root
+    root = data['root']
+    # 旧格式自带根哈希，没有区块头提供的根哈希时用它做校验
+    return legacy_leaf_data(root), merkle_root or (root['hash'] if root else None)
+
+
+def merkle_tree_from_dict(data, merkle_root=None, tree_class=None):
+    # 按叶子迭代重建整棵树，并校验重新计算的根哈希（通常是区块头中的merkle_root）
+    leaves, merkle_root = tree_leaf_data(data, merkle_root)
+    tree = (tree_class or MerkleTree)(leaves)
+    if merkle_root is not None and tree.get_root_hash() != merkle_root:
+        raise ValueError("Merkle root mismatch")
     return tree
 
+
+def merkle_tree_from_json(json_data, merkle_root=None):
+    return merkle_tree_from_dict(json.loads(json_data), merkle_root)
+
+
+def flat_merkle_tree_from_json(json_data, merkle_root=None):
+    return merkle_tree_from_dict(json.loads(json_data), merkle_root, FlatMerkleTree)
+
+
 if __name__ == "__main__":
     data = ["a", "b", "c","d","e","f",]
     tree = MerkleTree(data)
@@ -0,0 +1,139 @@
+import hashlib
+import multiprocessing
+import os
+import queue
+import time
+from Block import HEADER_NONCE, block_header_prefix, difficulty_target
+
+NONCE_SPACE = 2 ** 32  # nonce的取值空间（区块头中的32位字段）
+CHECK_INTERVAL = 1024  # 工作进程每计算这么多次哈希检查一次停止信号
+POLL_INTERVAL = 0.005  # 主进程轮询停止条件的间隔（秒）
+
+
+def mine_worker(worker_id, job_queue, result_queue, stop_event, hash_counts):
+    """挖矿工作进程：从任务队列取出区块头，在分到的nonce区间内搜索"""
+    pack_nonce = HEADER_NONCE.pack
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+        job_id, version, index, timestamp, merkle_root, previous_hash, difficulty, nonce_start, nonce_end = job
+        target = difficulty_target(difficulty)
+        # 区块头前缀只哈希一次，之后每个nonce复制这个中间状态（midstate）继续计算
+        midstate = hashlib.sha256(block_header_prefix(version, index, timestamp, merkle_root, previous_hash))
+        nonce = nonce_start
+        while not stop_event.is_set():
+            batch_end = min(nonce + CHECK_INTERVAL, nonce_end)
+            found = None
+            for n in range(nonce, batch_end):
+                sha = midstate.copy()
+                sha.update(pack_nonce(n))
+                digest = sha.digest()
+                if int.from_bytes(digest, "big") < target:
+                    found = (timestamp, n, digest.hex())
+                    break
+            hash_counts[worker_id] += (found[1] + 1 if found else batch_end) - nonce
+            if found:
+                result_queue.put((job_id, worker_id, found))
+                break
+            nonce = batch_end
+            if nonce >= nonce_end:
+                # 区间用完：滚动时间戳（相当于extra nonce），在同一区间重新搜索
+                # 各进程的nonce区间互不重叠，所以不会算出重复的区块头
+                timestamp = time.time()
+                midstate = hashlib.sha256(block_header_prefix(version, index, timestamp, merkle_root, previous_hash))
+                nonce = nonce_start
+        # 通知主进程本任务已结束
+        result_queue.put((job_id, worker_id, None))
+
+
+class Miner:
+    """多进程挖矿引擎：把nonce空间切分给进程池中的工作进程并行搜索"""
+
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        ctx = multiprocessing.get_context("spawn")  # 节点进程里有多个线程，使用spawn更安全
+        self.stop_event = ctx.Event()
+        self.result_queue = ctx.Queue()
+        self.job_queues = [ctx.Queue() for _ in range(self.workers)]
+        self.hash_counts = ctx.Array("Q", self.workers, lock=False)  # 每个进程各自的哈希计数
+        self.job_id = 0
+        self.start_time = time.time()
+        self.end_time = None
+        self.processes = []
+        for i in range(self.workers):
+            process = ctx.Process(
+                target=mine_worker,
+                args=(i, self.job_queues[i], self.result_queue, self.stop_event, self.hash_counts),
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+
+    def mine(self, block, difficulty, should_stop=lambda: False):
+        """为区块搜索满足难度的nonce，找到返回True并写回区块；should_stop()为真时提前放弃"""
+        if block.version == 0:
+            raise ValueError("Legacy (version 0) block headers cannot be mined")
+        self.job_id += 1
+        span = NONCE_SPACE // self.workers
+        for i in range(self.workers):
+            self.hash_counts[i] = 0
+        self.stop_event.clear()
+        self.start_time = time.time()
+        self.end_time = None
+        for i, job_queue in enumerate(self.job_queues):
+            nonce_start = i * span
+            nonce_end = NONCE_SPACE if i == self.workers - 1 else nonce_start + span
+            job_queue.put((self.job_id, block.version, block.index, block.timestamp, block.merkle_root,
+                           block.previous_hash, difficulty, nonce_start, nonce_end))
+
+        found = None
+        done = 0
+        while done < self.workers:
+            if found is None and should_stop():
+                self.stop_event.set()
+            try:
+                job_id, worker_id, result = self.result_queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if job_id != self.job_id:
+                continue
+            if result is None:
+                done += 1
+            elif found is None:
+                found = result
+                self.stop_event.set()  # 通知其他进程停止
+        self.end_time = time.time()
+
+        if found is None:
+            return False
+        block.timestamp, block.nonce, block.hash = found
+        return True
+
+    def hashrates(self):
+        """返回每个工作进程在最近一次任务中的算力（次/秒）"""
+        elapsed = (self.end_time or time.time()) - self.start_time
+        if elapsed <= 0:
+            return [0.0] * self.workers
+        return [count / elapsed for count in self.hash_counts]
+
+    def close(self):
+        self.stop_event.set()
+        for job_queue in self.job_queues:
+            job_queue.put(None)
+        for process in self.processes:
+            process.join(timeout=1.0)
+
+
+if __name__ == "__main__":
+    from MerkleTree import MerkleTree
+    from Block import Block
+
+    miner = Miner()
+    block = Block(1, MerkleTree(["a", "b", "c"]), "0" * 64, 0)
+    if miner.mine(block, 5):
+        print(block)
+        print(f"Verified: {block.hash == block.calculate_hash()}")
+    for i, rate in enumerate(miner.hashrates()):
+        print(f"Worker {i}: {rate:.0f} H/s")
+    miner.close()
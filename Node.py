@@ -1,12 +1,27 @@
+import os
 import socket
 import threading
+import struct
 import time
-from BlockChain import BlockChain, block_chain_from_json
-from Block import Block, block_from_json
-from MerkleTree import MerkleTree, merkle_tree_from_json
+from BlockChain import BlockChain, block_chain_from_json, iter_blocks_from_ndjson
+from BlockStore import BlockStore, UTXO_SNAPSHOT_INTERVAL
+from BlockTree import BlockTree, MAX_REORG_DEPTH
+from BlockSync import BlockSync, MAX_HEADERS
+from Block import Block, block_from_bytes, block_from_json, block_work
+from MerkleTree import MerkleTree, merkle_tree_from_json, hash_leaf, verify_merkle_proof
 import json
 from Wallet import Wallet
-from Transaction import Transaction,UTXO
+from Transaction import Transaction, TransactionCache, UTXO
+from Miner import Miner
+from SignatureVerifier import SignatureCache, SignatureVerifier
+from Mempool import Mempool, OrphanPool, TransactionAdmission
+from BlockTemplate import BLOCK_REWARD, BlockTemplate, missing_outpoints, transaction_fee
+from Codec import CODEC_BINARY, SUPPORTED_CODECS, choose_codec, decode_list, encode_list
+from Peer import (FRAME_BINARY, FRAME_CHAIN, FRAME_CHAIN_END, FRAME_TEXT, READ_TIMEOUT, TRANSPORT_FRAMED,
+                  PeerConnection, is_framed, read_frame)
+
+SYNC_BATCH = 64  # 同步整条链时，每批并行验证签名的区块数
+
 
 class Node:
     def __init__(self, ip):
@@ -17,16 +32,33 @@ class Node:
         self.socket.bind((ip, 5000))    # 监听5000端口
         self.socket.listen(5)
         self.hello_dict = {}
-        self.blockchain = BlockChain()
+        self.peer_codecs = {}  # 与各节点协商好的消息编码，格式: {节点地址: 编码}，未协商的用JSON
+        self.framed_peers = set()  # 支持长连接分帧传输的节点，其他节点每条消息单独建立连接
+        self.connections = {}  # 到各节点的长连接，格式: {节点地址: PeerConnection}
+        self.streaming = set()  # 正在通过长连接流式发送整条链的节点，同一节点同时只发送一条链
+        self.connections_lock = threading.Lock()
+        self.message_lock = threading.Lock()  # 每个连接有自己的读取线程，完整读到的消息仍逐条处理；读取socket时不持有
+        self.blockchain = BlockChain(BlockStore(os.path.join("chaindata", ip)))  # 重启后从磁盘恢复区块链
+        self.block_tree = BlockTree(self.blockchain)  # 竞争分支上的区块
+        self.undo_logs = {}  # 最近区块的UTXO回滚日志，格式: {区块哈希: [(utxo_key, 之前的UTXO或None)]}
+        self.block_sync = BlockSync(self)  # 先同步区块头再并行下载区块体
         self.data_queue = [f"Created by {ip}",]
         self.getBlock=False
         self.blockchain_lock = threading.Lock()  # 添加线程锁
         self.signal_lock = threading.Lock()
         self.data_lock = threading.Lock()
-        self.mempool = []  # 交易池
+        self.mempool = Mempool()  # 交易池，按交易哈希索引并检测双花，超过上限按手续费率驱逐
         self.mempool_lock = threading.Lock()  # 交易池的锁
+        self.orphans = OrphanPool()  # 父交易还没到的交易，按缺失的UTXO索引，与交易池共用mempool_lock
         self.global_utxo_pool = {}  # 全局UTXO池，格式: {tx_hash:output_index: UTXO}
         self.utxo_pool_lock = threading.Lock()  # 全局UTXO池的锁
+        self.tx_cache = TransactionCache()  # 解析后的交易，按默克尔叶子哈希缓存
+        self.block_template = BlockTemplate(self.tx_cache.serialize)  # 持续维护的区块模板，max_size为区块中普通交易的总字节数上限
+        self.miner = Miner()  # 多进程挖矿引擎
+        self.signature_cache = SignatureCache()  # 已验证有效的签名，交易池和区块验证共用
+        self.signature_verifier = SignatureVerifier(cache=self.signature_cache)  # 同步整条链时并行验证签名
+        self.admission = TransactionAdmission(self.signature_verifier, self.add_to_mempool)  # 收到的交易批量验证后进入交易池
+        self.confirmed_transactions = {}  # 已通过默克尔证明确认的交易，格式: {tx_hash: 区块高度}
         while True:
             try:
                 self.send_join()    # 发送加入消息
@@ -45,21 +77,30 @@ class Node:
         # 初始化UTXO池
         self.init_utxo_pool()
 
+        # 启动区块下载超时检查线程
+        self.block_sync_thread = threading.Thread(target=self.block_sync_loop)
+        self.block_sync_thread.daemon = True
+        self.block_sync_thread.start()
+
+        # 启动交易准入线程
+        self.admission.start()
+
         # 启动UTXO同步线程
         self.sync_thread = threading.Thread(target=self.sync_utxo_thread)
         self.sync_thread.daemon = True
         self.sync_thread.start()
 
-    def send_msg(self, msg):
+    def send_msg(self, msg, binary_msg=None):
+        # 协商了二进制编码的节点发送binary_msg，其他节点发送JSON文本；
+        # 两者也可以是生成消息的函数，只在有节点需要这种编码时调用一次
+        messages = {False: msg, True: binary_msg}
         for peer in list(self.peers):
             if peer == self.node_ip:
                 continue
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                try:
-                    s.connect((peer, 5000))
-                    s.sendall(msg.encode("utf-8"))
-                except:
-                    print(f"Failed to send message to {peer}")
+            binary = binary_msg is not None and self.peer_codecs.get(peer) == CODEC_BINARY
+            if callable(messages[binary]):
+                messages[binary] = messages[binary]()
+            self.send_to(peer, messages[binary])
 
     def send_data(self, data):
         self.send_msg(f"@DATA{data}")
@@ -69,40 +110,59 @@ class Node:
 
     def send_join(self):
         self.send_msg(f"@JOIN{self.node_ip}")
+        self.send_msg(f"@VERSION{self.version_message()}")
+
+    def version_message(self):
+        return json.dumps({"addr": self.node_ip, "codecs": SUPPORTED_CODECS, "transports": [TRANSPORT_FRAMED]})
+
+    def add_peer(self, addr):
+        # 新认识的节点：先协商消息编码
+        if addr not in self.peers and addr != self.node_ip:
+            self.send_to(addr, f"@VERSION{self.version_message()}")
+        self.peers.update([addr])
+
+    def handle_version(self, message_json, reply):
+        """记录对方支持的编码中双方都支持的最优的一个；不认识@VERSION的旧节点一直使用JSON"""
+        try:
+            message = json.loads(message_json)
+            addr, codecs = message["addr"], message["codecs"]
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Invalid version message: {e}")
+            return
+        self.peer_codecs[addr] = choose_codec(codecs)
+        if TRANSPORT_FRAMED in message.get("transports", []):
+            self.framed_peers.add(addr)
+        self.peers.update([addr])
+        if reply:
+            self.send_to(addr, f"#VERSION{self.version_message()}")
 
     def send_intro(self,addr):
         self.send_msg(f"#INTRO{addr}")
 
     def send_block(self,block:Block):
-        self.send_msg(f"@ONEBLOCK{block.to_json()}")
+        self.send_msg(lambda: f"@ONEBLOCK{block.to_json()}",
+                      lambda: b"%BLOCK" + block.to_bytes(self.tx_cache.binary_transaction))
     
-    def verify_block_transactions(self, block):
-        """验证区块中的所有交易，返回(是否全部有效, 无效交易列表)"""
-        transactions = []
+    def verify_block_transactions(self, block, check_signatures=True):
+        """验证区块中的所有交易，返回(是否全部有效, 无效交易列表)；签名已经批量验证过时可跳过签名检查"""
+        transactions = self.parse_block_transactions(block)
         invalid_transactions = []
-        
-        for leaf in block.merkle_tree.leaves:
-            try:
-                tx = Transaction.from_json(json.loads(leaf.data))
-                transactions.append(tx)
-            except:
-                continue  # 跳过非交易数据
 
         # 临时存储已使用的UTXO
         used_utxos = set()
+        # 本区块前面的交易产生的输出，后面的交易可以直接花费，格式: {tx_hash:output_index: 金额}
+        block_outputs = {}
+        total_fee = 0
 
         with self.utxo_pool_lock:
-            for tx in transactions:
-                # 如果是挖矿奖励交易（第一个交易），直接验证通过
-                if transactions.index(tx) == 0:
-                    if tx.outputs[0].amount != 50:
-                        print(f"Invalid mining reward transaction: {tx.tx_hash}")
-                        invalid_transactions.append(tx)
+            for position, tx in enumerate(transactions):
+                # 挖矿奖励交易（第一个交易）要等算出全部手续费后再验证
+                if position == 0:
                     continue
 
                 try:
                     # 1. 验证交易签名
-                    if not tx.verify_signature():
+                    if check_signatures and not self.signature_cache.verify(tx):
                         print(f"Invalid transaction signature: {tx.tx_hash}")
                         invalid_transactions.append(tx)
                         continue
@@ -119,10 +179,13 @@ class Node:
                             valid_inputs = False
                             break
 
-                        # 在全局UTXO池中查找这个UTXO
+                        # 在全局UTXO池和本区块前面交易的输出中查找这个UTXO
                         if utxo_key in self.global_utxo_pool:
                             total_input += self.global_utxo_pool[utxo_key].amount
                             used_utxos.add(utxo_key)
+                        elif utxo_key in block_outputs:
+                            total_input += block_outputs[utxo_key]
+                            used_utxos.add(utxo_key)
                         else:
                             print(f"UTXO not found in global pool: {utxo_key}")
                             valid_inputs = False
@@ -132,18 +195,28 @@ class Node:
                         invalid_transactions.append(tx)
                         continue
 
-                    # 3. 验证输入输出金额
+                    # 3. 验证输入输出金额，多出的部分是给矿工的手续费
                     total_output = sum(output.amount for output in tx.outputs)
-                    if total_input != total_output:
+                    if total_input < total_output:
                         print(f"Input/output amount mismatch: {tx.tx_hash}")
                         invalid_transactions.append(tx)
                         continue
+                    total_fee += total_input - total_output
+                    for i, output in enumerate(tx.outputs):
+                        block_outputs[f"{tx.tx_hash}:{i}"] = output.amount
 
                 except Exception as e:
                     print(f"Error verifying transaction {tx.tx_hash}: {e}")
                     invalid_transactions.append(tx)
                     continue
 
+            # 挖矿奖励交易的输出总额必须等于固定奖励加上区块内全部手续费
+            if transactions:
+                reward = transactions[0]
+                if sum(output.amount for output in reward.outputs) != BLOCK_REWARD + total_fee:
+                    print(f"Invalid mining reward transaction: {reward.tx_hash}")
+                    invalid_transactions.insert(0, reward)
+
         return len(invalid_transactions) == 0, invalid_transactions
 
     def parse_block(self, block_json):
@@ -152,141 +225,590 @@ class Node:
             return
         try:
             block = block_from_json(block_json)
-        except json.JSONDecodeError as e:
+        except (ValueError, KeyError, TypeError, struct.error) as e:  # 包括JSON错误、缺少字段和非法的区块头字段
             print(f"Failed to decode block JSON: {e}")
             return
-        if not block.merkle_tree or not block.merkle_tree.leaves:
+        self.receive_block(block)
+
+    def receive_block(self, block):
+        # 这里只看区块头；区块体在accept_block通过高度、前一区块和工作量证明检查后才解码
+        if not block.merkle_root:
             print("Merkle tree or leaves are not initialized")
             return
-        
-        if block.index > self.blockchain.height + 1:
-            # 直接使用区块中记录的矿工节点IP地址
-            self.send_blockchain_request(block.miner_address)
-            print(f"Request blockchain from {block.miner_address}")
-        else:
-            with self.blockchain_lock:
-                if self.blockchain.is_block_valid(block):
-                    # 先验证区块的所有交易
-                    if not self.verify_block_transactions(block):
-                        print(f"Rejected block {block.index}: invalid transactions")
-                        return
-                    
-                    # 如果所有交易都验证通过，接受区块并处理交易
+        if block.index < self.blockchain.height - MAX_REORG_DEPTH:
+            print(f"Ignored stale block {block.index}")
+            return
+
+        if self.accept_block(block) is None and block.miner_address:
+            # 父区块未知：先向矿工节点同步区块头，再从所有节点并行下载区块体
+            self.send_headers_request(block.miner_address, self.blockchain.get_locator())
+            print(f"Request headers from {block.miner_address}")
+
+    def accept_block(self, block, verified=()):
+        """接受区块：接在链尾、作为侧链保存，或者触发链重组。
+
+        verified为签名已经批量验证过的区块哈希，其他区块（包括重组分支上之前收到的侧链区块）仍逐个验证签名。
+        返回True表示区块已接受或已保存，False表示区块无效，None表示父区块未知。
+        """
+        deep_reorg = False
+        with self.blockchain_lock:
+            if self.blockchain.height_of(block.hash) is not None or block.hash in self.block_tree.side_blocks:
+                return True  # 已经收到过的区块
+            if block.previous_hash == self.blockchain.get_block_hash(self.blockchain.height - 1):
+                # 接在主链末尾：验证区块和其中的交易后接受
+                if not self.connect_block(block, check_signatures=block.hash not in verified):
+                    return False
+                with self.signal_lock:
+                    self.getBlock = True
+                print(f"Accepted block {block.index} :{block.hash}")
+                return True
+            if not self.blockchain.is_block_pow_valid(block):
+                print(f"Rejected block {block.index}: invalid proof of work")
+                return False
+            if not block.is_body_valid():
+                # 否则伪造的区块体会占住这个区块哈希，真正的区块再来时被当作已收到
+                print(f"Rejected block {block.index}: merkle tree does not match the header")
+                return False
+            # 接在其他位置：放入区块树，如果它所在的分支累计工作量更大就切换过去
+            work = self.block_tree.add_block(block)
+            if work is None:
+                return None
+            if work > self.blockchain.chain_work():
+                branch = self.block_tree.branch(block.hash)
+                # 回溯不到主链（祖先已被修剪）时与回滚日志不够一样，请求完整的链
+                reorganized = None if branch is None else self.reorganize(*branch, verified)
+                if reorganized is False:
+                    return False
+                if reorganized:
                     with self.signal_lock:
                         self.getBlock = True
-                    self.blockchain.append_block(block)
-                    # 处理新区块中的交易
-                    self.process_block_transactions(block)
-                    print(f"Accepted block {block.index} :{block.hash}")
+                else:
+                    deep_reorg = True
+            else:
+                print(f"Stored side block {block.index} :{block.hash}")
 
-    def send_blockchain_request(self,addr):
+        if deep_reorg and block.miner_address:
+            # 分叉深度超过保留的回滚日志，请求完整的链并整体重放
+            self.send_blockchain_request(block.miner_address)
+            print(f"Request blockchain from {block.miner_address}")
+        return True
+
+    def send_to(self, addr, msg):
+        # 支持分帧的节点通过长连接发送（不等待发送完成），旧版节点每条消息单独建立连接
+        payload = msg if isinstance(msg, bytes) else msg.encode("utf-8")
+        if addr in self.framed_peers:
+            self.get_connection(addr).send(FRAME_BINARY if isinstance(msg, bytes) else FRAME_TEXT, payload)
+            return
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             try:
                 s.connect((addr, 5000))
-                s.sendall(f"@BLOCKCHAIN{self.node_ip}".encode("utf-8"))
+                s.sendall(payload)
             except:
-                print(f"Failed to send blockchain request to {addr}")
+                print(f"Failed to send message to {addr}")
+
+    def get_connection(self, addr):
+        with self.connections_lock:
+            connection = self.connections.get(addr)
+            if connection is None:
+                connection = self.connections[addr] = PeerConnection(addr)
+            return connection
+
+    def close_connection(self, addr, connection=None):
+        # 指定connection时只在它仍是到addr的连接时移除（期间可能已经换成了新连接）
+        with self.connections_lock:
+            if connection is None:
+                connection = self.connections.pop(addr, None)
+            elif self.connections.get(addr) is connection:
+                del self.connections[addr]
+        if connection is not None:
+            connection.close()
+
+    def send_headers_request(self, addr, locator):
+        # 请求定位器之后的区块头
+        self.send_to(addr, f"@HEADERS{json.dumps({'addr': self.node_ip, 'locator': locator})}")
+
+    def send_headers(self, request_json):
+        # 回复定位器之后主链上的区块头
+        try:
+            request = json.loads(request_json)
+            addr, locator = request["addr"], request["locator"]
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Invalid headers request: {e}")
+            return
+        with self.blockchain_lock:
+            start = self.blockchain.locate(locator) + 1
+            end = min(start + MAX_HEADERS, self.blockchain.height)
+            headers = [self.blockchain.chain[height].header() for height in range(start, end)]
+        self.send_to(addr, f"#HEADERS{json.dumps({'addr': self.node_ip, 'headers': headers})}")
+
+    def send_blocks_request(self, addr, block_hashes):
+        self.send_to(addr, f"@GETBLOCKS{json.dumps({'addr': self.node_ip, 'hashes': block_hashes})}")
+
+    def send_blocks(self, request_json):
+        # 回复请求的区块体（主链或侧链上的都可以）
+        try:
+            request = json.loads(request_json)
+            addr, block_hashes = request["addr"], request["hashes"]
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Invalid blocks request: {e}")
+            return
+        blocks = []
+        with self.blockchain_lock:
+            for block_hash in block_hashes:
+                block = self.blockchain.get_block_by_hash(block_hash) or self.block_tree.side_blocks.get(block_hash)
+                if block is not None:
+                    blocks.append(block)
+        if self.peer_codecs.get(addr) == CODEC_BINARY:
+            # 第一项是本节点地址，之后是各个区块
+            payload = encode_list([self.node_ip.encode("utf-8")] + [block.to_bytes(self.tx_cache.binary_transaction) for block in blocks])
+            self.send_to(addr, b"%BLOCKS" + payload)
+        else:
+            blocks = [block.to_json() for block in blocks]
+            self.send_to(addr, f"#BLOCKS{json.dumps({'addr': self.node_ip, 'blocks': blocks})}")
+
+    def handle_headers(self, message_json):
+        try:
+            message = json.loads(message_json)
+            addr, headers = message["addr"], message["headers"]
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Invalid headers message: {e}")
+            return
+        self.block_sync.handle_headers(addr, headers)
+
+    def handle_blocks(self, message_json):
+        try:
+            message = json.loads(message_json)
+            addr, blocks = message["addr"], message["blocks"]
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Invalid blocks message: {e}")
+            return
+        self.block_sync.handle_blocks(addr, blocks)
+
+    def block_sync_loop(self):
+        """定期把超时的区块下载请求改派给其他节点"""
+        while True:
+            time.sleep(1)
+            self.block_sync.check_timeouts()
+
+    def send_blockchain_request(self,addr):
+        self.send_to(addr, f"@BLOCKCHAIN{self.node_ip}")
 
     def send_blockchain(self, addr):
-        blockchain_json = self.blockchain.to_json()
+        # 以NDJSON逐个区块发送，不在内存中拼出整条链。可能长时间等待对方，在单独的线程中调用
+        with self.blockchain_lock:
+            height = self.blockchain.height
+        if addr in self.framed_peers:
+            with self.connections_lock:
+                if addr in self.streaming:
+                    print(f"Already sending blockchain to {addr}")
+                    return
+                self.streaming.add(addr)
+            try:
+                self.stream_blockchain(addr, height)
+            finally:
+                with self.connections_lock:
+                    self.streaming.discard(addr)
+            return
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             try:
                 s.connect((addr, 5000))
-                s.sendall(f"#BLOCKCHAIN{blockchain_json}".encode("utf-8"))
+                s.sendall(b"#BLOCKCHAIN\n")
+                for height in range(1, height):
+                    with self.blockchain_lock:
+                        if height >= self.blockchain.height:
+                            break  # 发送期间本地链被重组变短了
+                        line = self.blockchain.chain[height].to_json() + "\n"
+                    s.sendall(line.encode("utf-8"))
             except:
                 print(f"Failed to send blockchain to {addr}")
 
+    def stream_blockchain(self, addr, height):
+        # 长连接上每个区块一帧；发送队列满时等待，内存占用与链长无关
+        connection = self.get_connection(addr)
+        sent = True
+        for height in range(1, height):
+            with self.blockchain_lock:
+                if height >= self.blockchain.height:
+                    break  # 发送期间本地链被重组变短了
+                line = self.blockchain.chain[height].to_json()
+            if not connection.send(FRAME_CHAIN, line.encode("utf-8"), wait=True):
+                sent = False
+                break
+        if sent and connection.send(FRAME_CHAIN_END, b"", wait=True):
+            return
+        # 连接已关闭或对方长时间不读：关闭连接让对方读到连接结束，不把发了一半的链留在连接上
+        print(f"Failed to send blockchain to {addr}")
+        self.close_connection(addr, connection)
+
+    def handle_blockchain(self, blocks):
+        """逐个处理对方发来的链：跳过与本地相同的前缀，之后的区块按顺序验证并连接。
+
+        分叉点之后的区块先暂存，直到它们的累计工作量超过本地链才切换过去，
+        因此内存占用只与分叉深度有关，与链长无关。切换之后的区块按SYNC_BATCH个一批处理。
+        每批区块的签名先在进程池中并行验证，UTXO仍按顺序逐个区块连接。
+        """
+        fork = None
+        switched = False
+        pending = []  # 分叉点之后、还没有连接的区块
+        try:
+            for block in blocks:
+                if fork is None:
+                    with self.blockchain_lock:
+                        if self.blockchain.height_of(block.hash) == block.index:
+                            continue  # 与本地相同的区块，已经验证过
+                    fork = block.index
+                if not self.blockchain.is_block_pow_valid(block):
+                    # 先做便宜的区块头检查，避免为无效的链做签名验证
+                    print(f"Rejected blockchain: invalid proof of work at block {block.index}")
+                    return False
+                pending.append(block)
+                if switched:
+                    # 已经切换到新链，后续区块攒够一批再接到链尾
+                    if len(pending) >= SYNC_BATCH:
+                        if not self.accept_blocks(pending):
+                            return False
+                        pending = []
+                    continue
+                with self.blockchain_lock:
+                    branch_work = self.blockchain.chain_work(fork) + len(pending) * block_work(self.blockchain.difficulty)
+                    if branch_work <= self.blockchain.chain_work():
+                        continue
+                if not self.verify_block_signatures(pending):
+                    return False
+                with self.blockchain_lock:
+                    # 验证签名期间其他连接可能已经改变了本地链：分叉点必须仍在链上，新分支也必须仍然更长
+                    if fork > self.blockchain.height or (
+                            fork > 0 and self.blockchain.get_block_hash(fork - 1) != pending[0].previous_hash):
+                        print(f"Rejected blockchain: local chain changed at block {fork} during sync")
+                        return False
+                    branch_work = self.blockchain.chain_work(fork) + len(pending) * block_work(self.blockchain.difficulty)
+                    if branch_work <= self.blockchain.chain_work():
+                        continue
+                    # 回滚日志不够回到分叉点时先重放UTXO池补齐
+                    self.ensure_undo_logs(fork)
+                    if not self.reorganize(fork, pending, {block.hash for block in pending}):
+                        print(f"Rejected blockchain: invalid block after {fork}")
+                        return False
+                with self.signal_lock:
+                    self.getBlock = True
+                switched = True
+                pending = []
+            if switched and pending and not self.accept_blocks(pending):
+                return False
+        except (ValueError, KeyError, TypeError) as e:  # 包括JSON错误和非法的哈希字段
+            print(f"Failed to decode blockchain: {e}")
+            return False
+        if switched:
+            print(f"Synchronized blockchain from block {fork}")
+        return True
+
+    def accept_blocks(self, blocks):
+        # 并行验证一批区块的签名，再按顺序逐个接受
+        if not self.verify_block_signatures(blocks):
+            return False
+        verified = {block.hash for block in blocks}
+        for block in blocks:
+            if not self.accept_block(block, verified):
+                print(f"Rejected blockchain at block {block.index}")
+                return False
+        return True
+
+    def verify_block_signatures(self, blocks):
+        """在进程池中并行验证这些区块中所有普通交易的签名（跳过每个区块的挖矿奖励交易）"""
+        transactions = [tx for block in blocks for tx in self.parse_block_transactions(block)[1:]]
+        invalid = self.signature_verifier.verify(transactions)
+        if invalid is not None:
+            print(f"Invalid transaction signature: {invalid}")
+            return False
+        return True
+
+    def send_proof_request(self, addr, tx_hash):
+        # 向节点请求交易的默克尔包含证明
+        request = json.dumps({"addr": self.node_ip, "tx_hash": tx_hash})
+        self.send_to(addr, f"@PROOF{request}")
+
+    def send_proof(self, request_json):
+        # 回复交易所在区块的区块头信息和默克尔证明
+        try:
+            request = json.loads(request_json)
+            addr, tx_hash = request["addr"], request["tx_hash"]
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Invalid proof request: {e}")
+            return
+        with self.blockchain_lock:
+            location = self.blockchain.find_transaction(tx_hash)
+            if location is None:
+                print(f"Transaction not found for proof request: {tx_hash}")
+                return
+            height, leaf_index = location
+            block = self.blockchain.chain[height]
+            response = json.dumps({
+                "tx_hash": tx_hash,
+                "block_index": height,
+                "block_hash": block.hash,
+                "merkle_root": block.merkle_root,
+                "leaf": block.merkle_tree.leaves[leaf_index].data,
+                "proof": block.merkle_tree.get_proof(leaf_index)
+            })
+        self.send_to(addr, f"#PROOF{response}")
+
+    def handle_proof(self, response_json):
+        # 只用本地区块头验证证明，不需要下载完整区块
+        try:
+            response = json.loads(response_json)
+            tx_hash, height = response["tx_hash"], response["block_index"]
+            proof, leaf = response["proof"], response["leaf"]
+            # 证明中的叶子必须就是这笔交易
+            if json.loads(leaf)["tx_hash"] != tx_hash or hash_leaf(leaf).hex() != proof["leaf_hash"]:
+                print(f"Proof leaf does not match transaction {tx_hash}")
+                return False
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Invalid proof response: {e}")
+            return False
+        with self.blockchain_lock:
+            if not 0 <= height < len(self.blockchain.chain):
+                print(f"Unknown block {height} in proof for {tx_hash}")
+                return False
+            block = self.blockchain.chain[height]
+            if block.hash != response.get("block_hash"):
+                print(f"Proof for {tx_hash} refers to a block not in our chain")
+                return False
+            merkle_root = block.merkle_root
+        if not verify_merkle_proof(proof, merkle_root):
+            print(f"Invalid merkle proof for {tx_hash}")
+            return False
+        self.confirmed_transactions[tx_hash] = height
+        print(f"Transaction {tx_hash} confirmed in block {height}")
+        return True
+
     def send_transaction(self, transaction):
         # 广播交易
-        self.mempool.append(transaction)
-        self.send_msg(f"@TRANSACTION{json.dumps(transaction.to_json())}")
+        self.add_to_mempool(transaction)
+        self.send_msg(f"@TRANSACTION{json.dumps(transaction.to_json())}", b"%TRANSACTION" + transaction.to_bytes())
 
     def handle_transaction(self, transaction_json):
         try:
             # 解析交易
             transaction = Transaction.from_json(json.loads(transaction_json))
-            
-            # 验证交易
-            if not transaction.verify_signature():
-                print(f"Invalid transaction signature: {transaction.tx_hash}")
-                return
-
-            # 添加到交易池
-            with self.mempool_lock:
-                if transaction not in self.mempool:
-                    self.mempool.append(transaction)
-                    print(f"Added transaction to mempool: {transaction.tx_hash}")
-
-
         except Exception as e:
             print(f"Error handling transaction: {e}")
+            return
+        # 只放进准入队列，签名验证在后台线程中批量进行
+        if not self.admission.submit(transaction):
+            print(f"Admission queue full, dropped transaction: {transaction.tx_hash}")
+
+    def add_to_mempool(self, transaction):
+        """把签名已验证的交易加入交易池；输入还不存在的交易先放进孤儿池，父交易加入后自动跟着加入。
+        返回transaction是否被接受（进入交易池或孤儿池）
+        """
+        accepted = False
+        pending = [transaction]
+        while pending:
+            tx = pending.pop(0)
+            with self.mempool_lock:
+                # 输入要在UTXO池或交易池中交易的输出里；手续费决定交易池满时的驱逐顺序
+                with self.utxo_pool_lock:
+                    missing = missing_outpoints(tx, self.global_utxo_pool, self.mempool.transactions)
+                    fee = None if missing else transaction_fee(tx, self.global_utxo_pool, self.mempool.transactions)
+                if missing:
+                    if self.orphans.add(tx, missing, len(self.tx_cache.serialize(tx))):
+                        print(f"Orphan transaction {tx.tx_hash} waiting for {len(missing)} inputs")
+                        accepted = accepted or tx is transaction
+                    continue
+                if fee is None:
+                    print(f"Transaction outputs exceed inputs: {tx.tx_hash}")
+                    continue
+                if not self.mempool.add(tx, fee, len(self.tx_cache.serialize(tx))):
+                    continue
+                # 等待这笔交易输出的孤儿交易现在可以加入了（签名已经验证过）
+                pending.extend(self.orphans.release(tx))
+            print(f"Added transaction to mempool: {tx.tx_hash}")
+            accepted = accepted or tx is transaction
+        return accepted
 
     def handle_connection(self):
         while True:
             conn, addr = self.socket.accept()
-            data = ""
-            while True:
-                part = conn.recv(1024).decode("utf-8")
-                if not part:
-                    break
-                data += part
-            # 处理接收到的数据
-            if data.startswith("@DATA"):
-                with self.data_lock:
-                    self.data_queue.append(data[5:])
-                print(f"Received data: {data[5:]}")
-
-            elif data.startswith("@HELLO"):
-                formaddr = data[6:]
-                self.peers.update([formaddr])
-                self.hello_dict[formaddr] = time.time()
-
-            elif data.startswith("@JOIN"):
-                formaddr = data[5:]
-                self.send_intro(formaddr)
-                self.peers.update([formaddr])
-                print(f"Join {formaddr}")
-
-            elif data.startswith("#INTRO"):
-                formaddr = data[6:]
-                self.peers.update([formaddr])
-                print(f"Intro {formaddr}")
-
-            elif data.startswith("@ONEBLOCK"):
-                self.parse_block(data[9:])
-
-            elif data.startswith("@BLOCKCHAIN"):
-                addr = data[11:]
-                self.send_blockchain(addr)
-
-            elif data.startswith("#BLOCKCHAIN"):
-                blockchain_json = data[11:]
-                try:
-                    new_blockchain = block_chain_from_json(blockchain_json)
-                except json.JSONDecodeError as e:
-                    print(f"Failed to decode blockchain JSON: {e}")
-                    continue
-                
-                if len(new_blockchain.chain) > len(self.blockchain.chain):
-                    if new_blockchain.is_chain_valid():
-                        # 验证区块链中的所有交易
-                        if self.verify_blockchain_transactions(new_blockchain):
-                            with self.blockchain_lock:
-                                self.blockchain = new_blockchain
-                                # 重新初始化UTXO池
-                            self.init_utxo_pool()
-                            print(f"Synchronized blockchain and updated UTXO pool")
-                        else:
-                            print("Rejected blockchain: invalid transactions")
-                    else:
-                        print("Rejected blockchain: invalid chain")
-
-            elif data.startswith("@TRANSACTION"):
-                # 处理新的交易
-                self.handle_transaction(data[12:])
+            # 对方停止发送（包括发了半帧就不动）超过READ_TIMEOUT时读取抛出超时，关闭连接释放读取线程
+            conn.settimeout(READ_TIMEOUT)
+            # 长连接会一直占用读取线程，每个连接单独一个线程
+            threading.Thread(target=self.handle_peer, args=(conn,), daemon=True).start()
 
+    def handle_peer(self, conn):
+        reader = conn.makefile("rb")
+        try:
+            if is_framed(reader):
+                self.handle_frames(reader)
+            else:
+                self.handle_legacy(reader)
+        except OSError as e:
+            print(f"Connection error: {e}")
+        finally:
+            reader.close()
             conn.close()
 
+    def handle_frames(self, reader):
+        """长连接：逐帧读取并处理，直到对方关闭连接或发来格式错误的帧。
+        读取socket时不持有message_lock，发送缓慢的节点不会挡住其他连接的消息
+        """
+        while True:
+            try:
+                frame = read_frame(reader)
+            except ValueError as e:
+                print(f"Invalid frame: {e}")
+                return
+            if frame is None:
+                return
+            if not self.handle_frame(frame, reader):
+                return
+
+    def handle_frame(self, frame, reader):
+        """处理一帧，返回False表示连接已经无法继续按帧读取"""
+        frame_type, payload = frame
+        if frame_type == FRAME_CHAIN:
+            # 流式的链：边读边验证，不把整条链读进内存；
+            # 读取和验证期间不持有message_lock，handle_blockchain只在修改链时获取blockchain_lock
+            finished = []
+            lines = self.chain_lines(payload, reader, finished)
+            self.handle_blockchain(iter_blocks_from_ndjson(lines))
+            # 链被拒绝时handle_blockchain会提前返回：读掉这条链剩下的帧，否则下一帧会被当作另一条链的开始
+            try:
+                for _ in lines:
+                    pass
+            except ValueError as e:
+                print(f"Invalid frame: {e}")
+            return bool(finished)  # 没有读到结束帧：对方已关闭或帧格式错误
+        elif frame_type in (FRAME_BINARY, FRAME_TEXT):
+            self.handle_received(payload, frame_type == FRAME_BINARY)
+        return True
+
+    def chain_lines(self, first_line, reader, finished):
+        # 流式链的各行，直到结束帧（读到时在finished中记录）；期间夹在中间的其他消息就地处理
+        yield first_line
+        while True:
+            frame = read_frame(reader)
+            if frame is None:
+                return
+            if frame[0] == FRAME_CHAIN_END:
+                finished.append(True)
+                return
+            if frame[0] == FRAME_CHAIN:
+                yield frame[1]
+            else:
+                self.handle_frame(frame, reader)
+
+    def handle_legacy(self, reader):
+        # 旧版节点：每个连接只有一条消息，读到对方关闭为止
+        first_line = reader.readline()
+        if first_line == b"#BLOCKCHAIN\n":
+            # 流式的链：边读边验证，不把整条链读进内存，也不持有message_lock
+            self.handle_blockchain(iter_blocks_from_ndjson(reader))
+            return
+        data = first_line + reader.read()
+        # 以%开头的是二进制编码的消息
+        self.handle_received(data, data.startswith(b"%"))
+
+    def handle_received(self, data, binary):
+        """处理一条已经完整读到的消息，只在处理期间持有message_lock，消息仍按到达顺序逐条处理。
+        整条链的JSON验证起来很慢，由handle_blockchain在修改链时自己获取blockchain_lock
+        """
+        if not binary and data.startswith(b"#BLOCKCHAIN"):
+            self.handle_blockchain_json(data[11:])
+            return
+        with self.message_lock:
+            if binary:
+                self.handle_binary(data)
+            else:
+                self.handle_message(data)
+
+    def handle_message(self, data):
+        try:
+            data = data.decode("utf-8")
+        except UnicodeDecodeError as e:
+            print(f"Failed to decode message: {e}")
+            return
+        # 处理接收到的数据
+        if data.startswith("@DATA"):
+            with self.data_lock:
+                self.data_queue.append(data[5:])
+            print(f"Received data: {data[5:]}")
+
+        elif data.startswith("@HELLO"):
+            formaddr = data[6:]
+            self.peers.update([formaddr])
+            self.hello_dict[formaddr] = time.time()
+
+        elif data.startswith("@JOIN"):
+            formaddr = data[5:]
+            self.send_intro(formaddr)
+            self.peers.update([formaddr])
+            print(f"Join {formaddr}")
+
+        elif data.startswith("#INTRO"):
+            formaddr = data[6:]
+            self.add_peer(formaddr)
+            print(f"Intro {formaddr}")
+
+        elif data.startswith("@VERSION"):
+            self.handle_version(data[8:], reply=True)
+
+        elif data.startswith("#VERSION"):
+            self.handle_version(data[8:], reply=False)
+
+        elif data.startswith("@ONEBLOCK"):
+            self.parse_block(data[9:])
+
+        elif data.startswith("@BLOCKCHAIN"):
+            addr = data[11:]
+            # 发送整条链可能要等对方很久，不能占着message_lock
+            threading.Thread(target=self.send_blockchain, args=(addr,), daemon=True).start()
+
+        elif data.startswith("#BLOCKCHAIN"):
+            self.handle_blockchain_json(data[11:])
+
+        elif data.startswith("@HEADERS"):
+            self.send_headers(data[8:])
+
+        elif data.startswith("#HEADERS"):
+            self.handle_headers(data[8:])
+
+        elif data.startswith("@GETBLOCKS"):
+            self.send_blocks(data[10:])
+
+        elif data.startswith("#BLOCKS"):
+            self.handle_blocks(data[7:])
+
+        elif data.startswith("@PROOF"):
+            self.send_proof(data[6:])
+
+        elif data.startswith("#PROOF"):
+            self.handle_proof(data[6:])
+
+        elif data.startswith("@TRANSACTION"):
+            # 处理新的交易
+            self.handle_transaction(data[12:])
+
+    def handle_blockchain_json(self, data):
+        # 旧版节点发来的整条链JSON数组
+        try:
+            blocks = block_chain_from_json(data).chain[1:]
+        except (ValueError, KeyError, TypeError, struct.error) as e:  # 包括JSON错误和非法的区块头字段
+            print(f"Failed to decode blockchain JSON: {e}")
+            return
+        self.handle_blockchain(blocks)
+
+    def handle_binary(self, data):
+        try:
+            if data.startswith(b"%BLOCKS"):
+                addr, *blocks = decode_list(data[7:])
+                self.block_sync.handle_blocks(addr.decode("utf-8"), blocks, block_from_bytes)
+            elif data.startswith(b"%BLOCK"):
+                self.receive_block(block_from_bytes(data[6:]))
+            elif data.startswith(b"%TRANSACTION"):
+                self.admission.submit(Transaction.from_bytes(data[12:]))
+        except (ValueError, KeyError, TypeError, struct.error) as e:  # 包括截断的数据和非法的区块头字段
+            print(f"Failed to decode binary message: {e}")
+
     def mainloop(self):
         while True:
             self.send_data(f"This is {self.node_ip}")
@@ -299,6 +821,7 @@ class Node:
                 if time.time() - self.hello_dict[peer] > 10:
                     self.peers.discard(peer)
                     del self.hello_dict[peer]
+                    self.close_connection(peer)
                     print(f"Discard {peer}")
             time.sleep(5)
 
@@ -323,75 +846,76 @@ class Node:
     def mine_thread(self):
         while True:
             with self.data_lock:
-                # 创建挖矿奖励交易
+                # 区块模板只处理交易池和链尾的变化：新交易在这里序列化、检查一次，之后每轮直接复用
+                # 交易池快照、链尾和UTXO池都在同一次持有blockchain_lock时读取：connect_block在这把锁内
+                # 移出已确认的交易，快照就不会包含刚被新链尾确认的交易
+                with self.blockchain_lock:
+                    with self.mempool_lock:
+                        self.mempool.expire()  # 停留太久仍未确认的交易（例如输掉双花竞争的）不再参与选择
+                        self.orphans.expire()
+                        transactions = dict(self.mempool.transactions)
+                        version = self.mempool.version
+                    height = self.blockchain.height
+                    previous_hash = self.blockchain.get_latest_block().hash
+                    with self.utxo_pool_lock:
+                        invalid_txs = self.block_template.update(transactions, version, self.global_utxo_pool)
+                    # 输入不存在或输出超过输入的交易不可能接在这个链尾之后，移出交易池
+                    if invalid_txs:
+                        with self.mempool_lock:
+                            for tx in invalid_txs:
+                                self.mempool.remove(tx.tx_hash)
+
+                # 创建挖矿奖励交易，模板按手续费率选中的交易的手续费一并奖励给矿工
                 mining_reward = Transaction()
                 reward_output = UTXO(
                     tx_hash=None,
                     output_index=0,
-                    amount=50,
+                    amount=BLOCK_REWARD + self.block_template.get_fees(),
                     recipient_address=self.wallet.address
                 )
                 mining_reward.outputs.append(reward_output)
-                mining_reward.block_index = self.blockchain.height
+                mining_reward.block_index = height
                 mining_reward.tx_hash = mining_reward.calculate_hash()
                 reward_output.tx_hash = mining_reward.tx_hash
-                
-                # 从交易池中选择交易
-                selected_transactions = []
-                with self.mempool_lock:
-                    selected_transactions = self.mempool
-                
-                # 将挖矿奖励交易放在第一位
-                all_transactions = [mining_reward] + selected_transactions
-                    
-                # 创建merkle树（注意这里需要先将交易转换为JSON字符串）
-                merkle_tree = MerkleTree([json.dumps(tx.to_json()) for tx in all_transactions])
 
-            # 创建区块并验证交易
-            block = Block(self.blockchain.height, merkle_tree, 
-                         self.blockchain.get_latest_block().hash, 
-                         0, time.time(), self.node_ip)
-            
-            # 验证交易并获取无效交易列表
-            is_valid, invalid_txs = self.verify_block_transactions(block)
-            
-            # 如果有无效交易，从交易池和选中的交易中移除它们
-            if invalid_txs:
-                with self.mempool_lock:
-                    self.mempool = [tx for tx in self.mempool if tx not in invalid_txs]
-                    selected_transactions = [tx for tx in selected_transactions if tx not in invalid_txs]
-                
-                # 重新创建merkle树（包含奖励交易和有效交易）
-                all_transactions = [mining_reward] + selected_transactions
-                merkle_tree = MerkleTree([json.dumps(tx.to_json()) for tx in all_transactions])
-                block = Block(self.blockchain.height, merkle_tree, 
-                            self.blockchain.get_latest_block().hash, 
-                            0, time.time(), self.node_ip)
-
-            # 尝试挖矿
-            nonce = 0
-            while not self.getBlock:
-                block.nonce = nonce
-                block.hash = block.calculate_hash()
-                if self.blockchain.is_block_valid(block):
-                    with self.blockchain_lock:
+                # 挖矿奖励交易在第一位；其余叶子和叶子哈希都来自模板缓存
+                merkle_tree = self.block_template.get_merkle_tree(mining_reward)
+
+            # 创建区块；模板中的交易已经对照这个链尾验证过签名、输入和金额，不必再验证整个区块
+            block = Block(height, merkle_tree, previous_hash, 0, time.time(), self.node_ip)
+
+            # 尝试挖矿：由多进程挖矿引擎搜索nonce，收到其他节点的区块时立即停止
+            if self.miner.mine(block, self.blockchain.difficulty, lambda: self.getBlock):
+                with self.blockchain_lock:
+                    # 搜索期间链可能已经变化，追加前再检查一次；链尾没变时UTXO池也没变
+                    if self.blockchain.is_block_valid(block):
                         self.send_block(block)
-                        self.blockchain.append_block(block)
-                        # 处理新区块中的交易
-                        self.process_block_transactions(block)
-                        # 从交易池中移除已确认的交易
-                        with self.mempool_lock:
-                            self.mempool = [tx for tx in self.mempool 
-                                          if tx not in selected_transactions]
+                        # 交易在模板中已经验证过，直接接到链尾并更新UTXO池（同时移出交易池）
+                        self.connect_block(block, verify=False)
                         # 同步钱包UTXO
                         self.sync_wallet_utxo()
+                        mined = True
+                    else:
+                        mined = False
+                if mined:
                     print(f"Mined block {block.index} :{block.hash}")
-                    
+                    rates = self.miner.hashrates()
+                    print(f"Hashrate: {sum(rates):.0f} H/s ({', '.join(f'{rate:.0f}' for rate in rates)})")
+                    stats = self.signature_cache.stats()
+                    print(f"Signature cache: {stats['hit_rate']:.1%} hit rate ({stats['hits']} hits, {stats['misses']} misses, {stats['size']} entries)")
+                    stats = self.mempool.stats()
+                    print(f"Mempool: {stats['count']} transactions, {stats['size']} bytes, "
+                          f"{stats['evicted']} evicted, {stats['expired']} expired, {stats['conflicted']} conflicted")
+                    stats = self.orphans.stats()
+                    print(f"Orphans: {stats['count']} waiting, {stats['released']} released, "
+                          f"{stats['evicted']} evicted, {stats['expired']} expired")
+                    stats = self.admission.stats()
+                    print(f"Transaction admission: queue {stats['queue_depth']}, {stats['admitted']} admitted, {stats['rejected']} rejected, "
+                          f"{stats['dropped']} dropped, "
+                          f"latency avg {stats['latency_avg'] * 1000:.1f} ms, max {stats['latency_max'] * 1000:.1f} ms")
+
                     # 打印钱包状态
                     self.print_wallet_status()
-                    
-                    break
-                nonce += 1
 
             with self.signal_lock:
                 self.getBlock = False
@@ -404,30 +928,69 @@ class Node:
             print(f"Sent data: {data}")
 
     def init_utxo_pool(self):
-        """初始化UTXO池，遍历区块链中的所有交易"""
-        self.global_utxo_pool = {}
+        """初始化UTXO池：有可用的快照时从快照开始只重放之后的区块，否则遍历区块链中的所有交易"""
         with self.blockchain_lock:
-            for block in self.blockchain.chain:
-                self.process_block_transactions(block)
+            snapshot = self.blockchain.chain.load_utxo_snapshot() if isinstance(self.blockchain.chain, BlockStore) else None
+            if snapshot is None:
+                # 最近的区块保留回滚日志，以便之后的链重组
+                self.replay_utxo_pool(self.blockchain.height - MAX_REORG_DEPTH)
+                return
+            start, self.global_utxo_pool, self.undo_logs = snapshot
+            self.replay_utxo_pool(self.blockchain.height - MAX_REORG_DEPTH, start)
+            while len(self.undo_logs) > MAX_REORG_DEPTH:
+                del self.undo_logs[next(iter(self.undo_logs))]
+            print(f"Loaded UTXO snapshot at block {start - 1}, replayed {self.blockchain.height - start} blocks")
 
-    def process_block_transactions(self, block):
-        """处理区块中的所有交易，更新UTXO池"""
+    def replay_utxo_pool(self, undo_from, start=0):
+        """从高度start重放UTXO池（start为0时从创世区块重建），为高度undo_from及之后的区块记录回滚日志。
+        调用者需持有blockchain_lock
+        """
+        if start == 0:
+            self.global_utxo_pool = {}
+            self.undo_logs = {}
+        for height in range(start, self.blockchain.height):
+            block = self.blockchain.chain[height]
+            undo = self.process_block_transactions(block)
+            if height >= undo_from:
+                self.undo_logs[block.hash] = undo
+
+    def save_utxo_snapshot(self):
+        # 把UTXO池和回滚日志存到区块存储的目录中，重启时不必从创世区块重放（调用者需持有blockchain_lock）
+        if not isinstance(self.blockchain.chain, BlockStore):
+            return
+        with self.utxo_pool_lock:
+            self.blockchain.chain.save_utxo_snapshot(self.global_utxo_pool, self.undo_logs)
+
+    def ensure_undo_logs(self, fork):
+        # 分叉比保留的回滚日志更深时，重放一次UTXO池补齐到分叉点的日志（调用者需持有blockchain_lock）
+        for height in range(fork, self.blockchain.height):
+            if self.blockchain.get_block_hash(height) not in self.undo_logs:
+                print(f"Replaying UTXO pool to reorganize from block {fork}")
+                self.replay_utxo_pool(fork)
+                return
+
+    def parse_block_transactions(self, block):
+        """把区块的叶子解析成交易列表，跳过非交易数据"""
         transactions = []
         for leaf in block.merkle_tree.leaves:
-            try:
-                # 解析JSON字符串
-                tx_data = json.loads(leaf.data)
-                tx = Transaction.from_json(tx_data)
+            # 同一笔交易在交易池、区块模板和收到的区块中叶子相同，只解析一次
+            tx = self.tx_cache.parse_leaf(leaf)
+            if tx is not None:
                 transactions.append(tx)
-            except Exception as e:
-                continue
+        return transactions
+
+    def process_block_transactions(self, block):
+        """处理区块中的所有交易，更新UTXO池；返回回滚日志，用于链重组时撤销这些修改"""
+        transactions = self.parse_block_transactions(block)
+        undo = []
 
         with self.utxo_pool_lock:
-            for tx in transactions:
+            for position, tx in enumerate(transactions):
                 # 如果是挖矿奖励交易（第一个交易），直接添加输出到UTXO池
-                if transactions.index(tx) == 0:
+                if position == 0:
                     for i, output in enumerate(tx.outputs):
                         utxo_key = f"{tx.tx_hash}:{i}"
+                        undo.append((utxo_key, self.global_utxo_pool.get(utxo_key)))
                         self.global_utxo_pool[utxo_key] = output
                         # 确保将奖励交易的输出添加到钱包的UTXO池
                         # if output.recipient_address == self.wallet.address:
@@ -438,47 +1001,103 @@ class Node:
                 # 1. 移除已使用的UTXO
                 for utxo in tx.inputs:
                     utxo_key = f"{utxo.tx_hash}:{utxo.output_index}"
-                    self.global_utxo_pool.pop(utxo_key, None)
+                    undo.append((utxo_key, self.global_utxo_pool.pop(utxo_key, None)))
                     # if utxo.recipient_address == self.wallet.address:
                     #     self.wallet.remove_utxo(utxo)
 
                 # 2. 添加新的UTXO
                 for i, output in enumerate(tx.outputs):
                     utxo_key = f"{tx.tx_hash}:{i}"
+                    undo.append((utxo_key, self.global_utxo_pool.get(utxo_key)))
                     self.global_utxo_pool[utxo_key] = output
                     # 如果是发给自己的，也添加到钱包的UTXO池
                     # if output.recipient_address == self.wallet.address:
                     #     self.wallet.add_utxo(output)
 
-    def verify_blockchain_transactions(self, blockchain):
-        """验证区块链中所有区块的所有交易"""
-        print("Verifying all transactions in the blockchain...")
-        
-        # 保存当前的UTXO池状态
-        original_utxo_pool = self.global_utxo_pool.copy()
-        self.global_utxo_pool = {}  # 临时清空UTXO池
-        
-        try:
-            # 按顺序验证每个区块
-            for block in blockchain.chain:
-                is_valid, invalid_txs = self.verify_block_transactions(block)
-                if not is_valid:
-                    print(f"Invalid transactions found in block {block.index}")
-                    return False
-                
-                # 如果验证通过，处理这个区块的交易（更新UTXO池)
-                self.process_block_transactions(block)
-            
-            print("All transactions in the blockchain are valid")
-            return True
-            
-        except Exception as e:
-            print(f"Error during blockchain verification: {e}")
-            return False
-            
-        finally:
-            # 恢复原始UTXO池状态
-            self.global_utxo_pool = original_utxo_pool
+        return undo
+
+    def undo_block_transactions(self, undo):
+        """按回滚日志倒序恢复UTXO池"""
+        with self.utxo_pool_lock:
+            for utxo_key, previous in reversed(undo):
+                if previous is None:
+                    self.global_utxo_pool.pop(utxo_key, None)
+                else:
+                    self.global_utxo_pool[utxo_key] = previous
+
+    def connect_block(self, block, verify=True, check_signatures=True):
+        """把区块接到链尾并更新UTXO池，记录回滚日志（调用者需持有blockchain_lock）"""
+        if verify:
+            if not self.blockchain.is_block_valid(block):
+                return False
+            is_valid, _ = self.verify_block_transactions(block, check_signatures)
+            if not is_valid:
+                print(f"Rejected block {block.index}: invalid transactions")
+                return False
+        self.blockchain.append_block(block)
+        self.block_tree.remove_block(block.hash)
+        self.undo_logs[block.hash] = self.process_block_transactions(block)
+        # 已确认的交易和与它们双花的交易移出交易池（跳过挖矿奖励交易），等待区块中交易输出的孤儿交易可以加入交易池了
+        transactions = self.parse_block_transactions(block)
+        with self.mempool_lock:
+            self.mempool.remove_confirmed(transactions[1:])
+            released = []
+            for tx in transactions:
+                self.orphans.remove(tx.tx_hash)
+                released.extend(self.orphans.release(tx))
+        for tx in released:
+            self.add_to_mempool(tx)
+        # 只保留最近MAX_REORG_DEPTH个区块的回滚日志（字典按连接顺序排列，最早的在前）
+        while len(self.undo_logs) > MAX_REORG_DEPTH:
+            del self.undo_logs[next(iter(self.undo_logs))]
+        if self.blockchain.height % UTXO_SNAPSHOT_INTERVAL == 0:
+            self.save_utxo_snapshot()
+        return True
+
+    def disconnect_tip(self):
+        """断开链尾区块：按回滚日志恢复UTXO池，区块转入侧链（调用者需持有blockchain_lock）"""
+        undo = self.undo_logs.pop(self.blockchain.get_block_hash(self.blockchain.height - 1))
+        self.undo_block_transactions(undo)
+        self.block_template.invalidate()  # 回滚的区块产生的UTXO消失了，模板要复查全部交易
+        block = self.blockchain.pop_block()
+        self.block_tree.add_block(block)
+        return block
+
+    def reorganize(self, fork, blocks, verified=()):
+        """切换到从高度fork开始的新分支：只回滚旧分支上的区块，再依次验证并连接新分支。
+
+        成功返回True，新分支有无效区块时恢复原链并返回False；
+        回滚日志不够回到分叉点时返回None，由调用者完整重放。调用者需持有blockchain_lock。
+        verified为签名已经批量验证过的区块哈希，新分支上的其他区块仍逐个验证签名。
+        """
+        for height in range(fork, self.blockchain.height):
+            if self.blockchain.get_block_hash(height) not in self.undo_logs:
+                return None
+        disconnected = []
+        while self.blockchain.height > fork:
+            disconnected.append(self.disconnect_tip())
+        for block in blocks:
+            if not self.connect_block(block, check_signatures=block.hash not in verified):
+                print(f"Reorganization failed at block {block.index}, restoring previous chain")
+                while self.blockchain.height > fork:
+                    self.disconnect_tip()
+                for old_block in reversed(disconnected):
+                    self.connect_block(old_block, verify=False)
+                # 无效区块之后的分支区块也不可能再被连接
+                self.block_tree.remove_subtree(block.hash)
+                return False
+        if disconnected:
+            print(f"Reorganized chain: {len(disconnected)} blocks disconnected, {len(blocks)} connected")
+            self.return_to_mempool(disconnected)
+        return True
+
+    def return_to_mempool(self, blocks):
+        # 被回滚的区块中没有进入新链的交易重新放回交易池（跳过挖矿奖励交易）
+        # blocks从最新的区块开始排列，倒序处理让父交易先于较新区块中的子交易放回
+        for block in reversed(blocks):
+            for tx in self.parse_block_transactions(block)[1:]:
+                if tx.tx_hash not in self.mempool and self.blockchain.find_transaction(tx.tx_hash) is None:
+                    self.add_to_mempool(tx)
 
     def print_wallet_status(self):
         """打印钱包状态"""
@@ -0,0 +1,173 @@
+import queue
+import select
+import socket
+import struct
+import threading
+import time
+
+PORT = 5000
+TRANSPORT_FRAMED = "framed1"  # 在@VERSION中声明支持长连接分帧传输
+
+FRAME_HEADER = struct.Struct(">BI")  # 帧类型, 内容长度
+FRAME_TEXT = 1  # UTF-8文本消息（@或#开头）
+FRAME_BINARY = 2  # 二进制编码的消息（%开头）
+FRAME_CHAIN = 3  # 流式发送整条链时的一个区块（NDJSON的一行）
+FRAME_CHAIN_END = 4  # 整条链发送完毕
+FRAME_TYPES = (FRAME_TEXT, FRAME_BINARY, FRAME_CHAIN, FRAME_CHAIN_END)  # 都不是旧版消息开头的@、#、%
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+SEND_QUEUE_SIZE = 10000  # 每个连接最多排队的帧数，队列满时丢弃新的普通消息
+PIPELINE_FRAMES = 256  # 一次写入的最多帧数
+CONNECT_TIMEOUT = 5
+SEND_TIMEOUT = 30  # 对方长时间不读时放弃这个连接并重连
+READ_TIMEOUT = 60  # 接受的连接超过这么多秒收不到任何数据就关闭；长连接上每5秒就有一次@HELLO
+STREAM_TIMEOUT = 60  # 流式发送时发送队列持续这么多秒没有空位（对方不可达或不读）就放弃
+STREAM_POLL = 1  # 流式发送等待队列空位时，每隔这么多秒检查一次连接是否已关闭
+RECONNECT_MIN = 1  # 连接失败后第一次重连前等待的秒数，之后每次失败翻倍
+RECONNECT_MAX = 30
+
+
+def encode_frame(frame_type, payload):
+    return FRAME_HEADER.pack(frame_type, len(payload)) + payload
+
+
+def read_frame(reader):
+    """从连接中读取一帧，返回(帧类型, 内容)；对方正常关闭时返回None，数据不完整或格式错误时抛出ValueError"""
+    header = reader.read(FRAME_HEADER.size)
+    if not header:
+        return None
+    if len(header) < FRAME_HEADER.size:
+        raise ValueError("Truncated frame header")
+    frame_type, length = FRAME_HEADER.unpack(header)
+    if frame_type not in FRAME_TYPES:
+        raise ValueError(f"Unknown frame type {frame_type}")
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame too large: {length} bytes")
+    payload = reader.read(length)
+    if len(payload) < length:
+        raise ValueError("Truncated frame")
+    return frame_type, payload
+
+
+def is_framed(reader):
+    # 看一眼第一个字节：分帧连接以帧类型开头，旧版节点的消息以@、#或%开头
+    first = reader.peek(1)[:1]
+    return bool(first) and first[0] in FRAME_TYPES
+
+
+class PeerConnection:
+    """到一个节点的长连接：消息按帧放进发送队列，由后台线程连续写出，多条消息共用一个TCP连接。
+    连接失败或断开后按指数退避重连，排队的消息在重连后继续发送。
+    """
+
+    def __init__(self, addr, port=PORT):
+        self.addr = addr
+        self.port = port
+        self.queue = queue.Queue(SEND_QUEUE_SIZE)
+        self.sock = None
+        self.backoff = RECONNECT_MIN
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+        self.connects = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def send(self, frame_type, payload, wait=False):
+        """把一帧放进发送队列。队列满时普通消息直接丢弃并返回False；wait=True时等待（用于流式发送整条链），
+        连接已关闭或等待超过STREAM_TIMEOUT时返回False
+        """
+        if self.closed:
+            return False
+        frame = encode_frame(frame_type, payload)
+        if not wait:
+            try:
+                self.queue.put_nowait(frame)
+            except queue.Full:
+                self.dropped += 1
+                print(f"Send queue to {self.addr} is full, dropping message")
+                return False
+            return True
+        deadline = time.time() + STREAM_TIMEOUT
+        while not self.closed:
+            try:
+                self.queue.put(frame, timeout=STREAM_POLL)
+                return True
+            except queue.Full:
+                if time.time() >= deadline:
+                    print(f"Send queue to {self.addr} stalled for {STREAM_TIMEOUT} s, giving up")
+                    return False
+        return False
+
+    def run(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None or self.closed:
+                break
+            # 把已经排队的帧一起写出
+            frames = [frame]
+            while len(frames) < PIPELINE_FRAMES:
+                try:
+                    frame = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if frame is None:
+                    self.closed = True
+                    break
+                frames.append(frame)
+            data = b"".join(frames)
+            while not self.closed:
+                if self.sock is not None and not self.alive():
+                    self.disconnect()
+                if self.sock is None and not self.connect():
+                    continue
+                try:
+                    self.sock.sendall(data)
+                    self.sent += len(frames)
+                    break
+                except OSError as e:
+                    # 对方关闭或重启了：重连后重发这一批（对方丢弃不完整的帧）
+                    print(f"Connection to {self.addr} lost: {e}")
+                    self.disconnect()
+        self.disconnect()
+
+    def connect(self):
+        try:
+            sock = socket.create_connection((self.addr, self.port), timeout=CONNECT_TIMEOUT)
+        except OSError as e:
+            print(f"Failed to connect to {self.addr}: {e}, retrying in {self.backoff} s")
+            time.sleep(self.backoff)
+            self.backoff = min(self.backoff * 2, RECONNECT_MAX)
+            return False
+        sock.settimeout(SEND_TIMEOUT)
+        self.sock = sock
+        self.backoff = RECONNECT_MIN
+        self.connects += 1
+        return True
+
+    def alive(self):
+        # 这个连接只发不收：可读就说明对方已经关闭，写入会在对方丢失，先重连
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            return not readable or self.sock.recv(1, socket.MSG_PEEK) != b""
+        except OSError:
+            return False
+
+    def disconnect(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def close(self):
+        """丢弃还没发出的消息并关闭连接"""
+        self.closed = True
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def stats(self):
+        return {"queued": self.queue.qsize(), "sent": self.sent, "dropped": self.dropped, "connects": self.connects}
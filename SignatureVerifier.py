@@ -0,0 +1,177 @@
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import Signing
+from Transaction import Transaction
+
+BATCH_SIZE = 32  # 每个任务包含的签名数；少于这个数时直接在当前进程验证，省去进程间通信
+SIGNATURE_CACHE_SIZE = 50000  # 最多记住这么多个已验证有效的签名
+
+
+def signature_key(tx):
+    return tx.tx_hash, tx.signature, tx.sender_public_key
+
+
+def signature_valid(item):
+    tx = Transaction()
+    tx.tx_hash, tx.signature, tx.sender_public_key = item
+    try:
+        return tx.verify_signature()
+    except Exception:  # 交易哈希等字段格式错误
+        return False
+
+
+def verify_batch(items):
+    """工作进程：依次验证(tx_hash, signature, sender_public_key)，返回第一个无效签名的交易哈希，全部有效返回None"""
+    for item in items:
+        if not signature_valid(item):
+            return item[0]
+    return None
+
+
+def check_batch(items):
+    # 工作进程：逐个验证，返回每个签名是否有效
+    return [signature_valid(item) for item in items]
+
+
+class SignatureCache:
+    """已验证有效的(tx_hash, signature, sender_public_key)的LRU缓存。
+
+    交易进入交易池时验证过的签名，在区块到来或整条链重新同步时不必再做ECDSA验证。
+    """
+
+    def __init__(self, size=SIGNATURE_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def contains(self, tx):
+        key = signature_key(tx)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, items):
+        # items为已验证有效的(tx_hash, signature, sender_public_key)
+        with self.lock:
+            for key in items:
+                self.entries[key] = True
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def verify(self, tx):
+        """验证单笔交易的签名，命中缓存时不做ECDSA验证"""
+        if self.contains(tx):
+            return True
+        key = signature_key(tx)
+        if not signature_valid(key):
+            return False
+        self.add([key])
+        return True
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate()}
+
+
+class SignatureVerifier:
+    """多进程签名验证：把大量交易的ECDSA验证分批交给进程池，任一签名无效时取消其余任务"""
+
+    def __init__(self, workers=None, cache=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.cache = cache  # 可选的SignatureCache：跳过已验证过的签名，并记住新验证通过的
+        self.executor = None  # 第一次需要时才启动进程池
+        self.lock = threading.Lock()  # 同步线程和交易准入线程共用进程池
+
+    def verify(self, transactions):
+        """验证交易签名，全部有效返回None，否则返回发现的无效交易的哈希"""
+        items = [signature_key(tx) for tx in transactions if self.cache is None or not self.cache.contains(tx)]
+        if len(items) <= BATCH_SIZE or self.workers == 1:
+            invalid = verify_batch(items)
+            if invalid is None and self.cache is not None:
+                self.cache.add(items)
+            return invalid
+        executor = self.get_executor()
+        batches = {}
+        for i in range(0, len(items), BATCH_SIZE):
+            batch = items[i:i + BATCH_SIZE]
+            batches[executor.submit(verify_batch, batch)] = batch
+        pending = set(batches)
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    invalid = future.result()
+                    if invalid is not None:
+                        return invalid
+                    if self.cache is not None:
+                        self.cache.add(batches[future])
+            return None
+        finally:
+            # 发现无效签名时，还没开始的批次直接取消
+            for future in pending:
+                future.cancel()
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                # 节点进程里有多个线程，使用spawn更安全；工作进程使用与主进程相同的签名后端
+                self.executor = ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context("spawn"),
+                    initializer=Signing.set_backend, initargs=(Signing.backend.name,)
+                )
+            return self.executor
+
+    def verify_each(self, transactions):
+        """逐笔验证交易签名，返回与transactions一一对应的结果；不会因为某笔无效而停止"""
+        results = [True] * len(transactions)
+        todo = [i for i, tx in enumerate(transactions) if self.cache is None or not self.cache.contains(tx)]
+        items = [signature_key(transactions[i]) for i in todo]
+        if len(items) <= BATCH_SIZE or self.workers == 1:
+            checked = check_batch(items)
+        else:
+            batches = [items[i:i + BATCH_SIZE] for i in range(0, len(items), BATCH_SIZE)]
+            checked = [valid for batch in self.get_executor().map(check_batch, batches) for valid in batch]
+        for i, valid in zip(todo, checked):
+            results[i] = valid
+        if self.cache is not None:
+            self.cache.add([item for item, valid in zip(items, checked) if valid])
+        return results
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+
+if __name__ == "__main__":
+    import time
+    from Wallet import Wallet
+    from Transaction import UTXO
+
+    sender, recipient = Wallet(), Wallet()
+    transactions = []
+    for i in range(200):
+        sender.utxo_pool = [UTXO(f"{i:064x}", 0, 100, sender.address)]
+        transactions.append(sender.create_transaction(recipient.address, 30))
+    verifier = SignatureVerifier()
+    for name, workers in (("serial", 1), (f"{verifier.workers} processes", verifier.workers)):
+        verifier.workers = workers
+        start = time.perf_counter()
+        result = verifier.verify(transactions)
+        print(f"{name:<14} {len(transactions)} signatures in {time.perf_counter() - start:.3f} s, invalid: {result}")
+    transactions[150].signature = transactions[0].signature
+    print(f"Tampered signature detected: {verifier.verify(transactions) == transactions[150].tx_hash}")
+    verifier.close()
@@ -0,0 +1,154 @@
+import threading
+from collections import OrderedDict
+import ecdsa
+from ecdsa.ellipticcurve import PointJacobi
+
+KEY_CACHE_SIZE = 1024  # 每个后端最多缓存的密钥对象数
+PRECOMPUTE_AFTER = 8  # 同一公钥验证这么多次后再建预计算表（建表的耗时约等于8次验证）
+
+
+class KeyCache:
+    """原始密钥字节 -> 密钥对象的LRU缓存，同时记录每个密钥被使用的次数"""
+
+    def __init__(self, load, size=KEY_CACHE_SIZE):
+        self.load = load
+        self.size = size
+        self.entries = OrderedDict()  # 格式: {密钥字节: [密钥对象, 使用次数]}
+        self.lock = threading.Lock()
+
+    def get(self, key_bytes):
+        """返回(密钥对象, 包括本次在内的使用次数)"""
+        with self.lock:
+            entry = self.entries.get(key_bytes)
+            if entry is not None:
+                self.entries.move_to_end(key_bytes)
+                entry[1] += 1
+                return entry[0], entry[1]
+        key = self.load(key_bytes)
+        with self.lock:
+            self.entries[key_bytes] = [key, 1]
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return key, 1
+
+    def replace(self, key_bytes, key):
+        with self.lock:
+            if key_bytes in self.entries:
+                self.entries[key_bytes][0] = key
+
+
+def raw_public_key(public_key):
+    # 去掉未压缩公钥的0x04前缀，得到64字节的x||y
+    return public_key[1:] if len(public_key) == 65 and public_key[0] == 0x04 else public_key
+
+
+class EcdsaBackend:
+    """默认后端：纯Python的ecdsa包。签名格式为64字节r||s，对数据先做SHA-1（与ecdsa包的默认行为相同）"""
+
+    name = "ecdsa"
+
+    def __init__(self):
+        self.signing_keys = KeyCache(lambda key: ecdsa.SigningKey.from_string(key, curve=ecdsa.SECP256k1))
+        self.verifying_keys = KeyCache(lambda key: ecdsa.VerifyingKey.from_string(key, curve=ecdsa.SECP256k1))
+
+    def public_key(self, private_key):
+        signing_key, _ = self.signing_keys.get(private_key)
+        return b'\x04' + signing_key.verifying_key.to_string()
+
+    def sign(self, private_key, data):
+        signing_key, _ = self.signing_keys.get(private_key)
+        return signing_key.sign(data)
+
+    def verify(self, public_key, signature, data):
+        try:
+            raw = raw_public_key(public_key)
+            verifying_key, uses = self.verifying_keys.get(raw)
+            if uses == PRECOMPUTE_AFTER:
+                # 经常使用的公钥：换成带乘法预计算表的点，之后每次验证快约一倍
+                curve = ecdsa.SECP256k1
+                point = verifying_key.pubkey.point
+                point = PointJacobi(curve.curve, point.x(), point.y(), 1, curve.order, generator=True)
+                verifying_key = ecdsa.VerifyingKey.from_public_point(point, curve=curve)
+                self.verifying_keys.replace(raw, verifying_key)
+            return verifying_key.verify(signature, data)
+        except Exception:  # 签名不匹配，或者公钥、签名的格式错误
+            return False
+
+
+class CryptographyBackend:
+    """可选后端：基于OpenSSL的cryptography包，签名格式与ecdsa后端相同，可以互相验证"""
+
+    name = "cryptography"
+
+    def __init__(self):
+        from cryptography.exceptions import InvalidSignature
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import ec, utils
+        self.InvalidSignature = InvalidSignature
+        self.serialization = serialization
+        self.utils = utils
+        self.algorithm = ec.ECDSA(hashes.SHA1())
+        curve = ec.SECP256K1()
+        self.signing_keys = KeyCache(lambda key: ec.derive_private_key(int.from_bytes(key, "big"), curve))
+        self.verifying_keys = KeyCache(
+            lambda key: ec.EllipticCurvePublicKey.from_encoded_point(curve, b'\x04' + key)
+        )
+
+    def public_key(self, private_key):
+        signing_key, _ = self.signing_keys.get(private_key)
+        return signing_key.public_key().public_bytes(
+            self.serialization.Encoding.X962, self.serialization.PublicFormat.UncompressedPoint
+        )
+
+    def sign(self, private_key, data):
+        signing_key, _ = self.signing_keys.get(private_key)
+        r, s = self.utils.decode_dss_signature(signing_key.sign(data, self.algorithm))
+        return r.to_bytes(32, "big") + s.to_bytes(32, "big")
+
+    def verify(self, public_key, signature, data):
+        try:
+            verifying_key, _ = self.verifying_keys.get(raw_public_key(public_key))
+            if len(signature) != 64:
+                return False
+            der = self.utils.encode_dss_signature(
+                int.from_bytes(signature[:32], "big"), int.from_bytes(signature[32:], "big")
+            )
+            verifying_key.verify(der, data, self.algorithm)
+            return True
+        except (self.InvalidSignature, ValueError, TypeError):
+            return False
+
+
+BACKENDS = {backend.name: backend for backend in (EcdsaBackend, CryptographyBackend)}
+backend = EcdsaBackend()
+
+
+def available_backends():
+    """返回当前环境中可以使用的后端名称（可选后端的依赖没有安装时跳过）"""
+    names = []
+    for name, backend_class in BACKENDS.items():
+        try:
+            backend_class()
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+def set_backend(name):
+    """切换全局使用的签名后端"""
+    global backend
+    backend = BACKENDS[name]()
+    return backend
+
+
+def public_key(private_key):
+    return backend.public_key(private_key)
+
+
+def sign(private_key, data):
+    return backend.sign(private_key, data)
+
+
+def verify(public_key, signature, data):
+    return backend.verify(public_key, signature, data)
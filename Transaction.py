@@ -1,7 +1,12 @@
 import hashlib
-import ecdsa
+import Signing
 import json
 import base64  # 用于编码字节类型数据
+import threading
+from collections import OrderedDict
+from Codec import Reader, Writer
+
+TX_CACHE_SIZE = 10000  # 解析后交易缓存的最大条数
 
 class UTXO:
     def __init__(self, tx_hash, output_index, amount, recipient_address):
@@ -27,6 +32,33 @@ class UTXO:
             recipient_address=json_data["recipient_address"]
         )
 
+    def write(self, writer):
+        writer.string(self.tx_hash)
+        writer.optional_number(self.output_index)
+        writer.number(self.amount)
+        writer.string(self.recipient_address, prefix="0x")
+
+    @classmethod
+    def read(cls, reader):
+        return cls(
+            tx_hash=reader.string(),
+            output_index=reader.optional_number(),
+            amount=reader.number(),
+            recipient_address=reader.string(prefix="0x")
+        )
+
+    def to_bytes(self):
+        writer = Writer()
+        self.write(writer)
+        return writer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        reader = Reader(data)
+        utxo = cls.read(reader)
+        reader.end()
+        return utxo
+
     def __repr__(self):
         return f"UTXO(tx_hash={self.tx_hash}, output_index={self.output_index}, amount={self.amount}, recipient={self.recipient_address})"
 
@@ -60,6 +92,42 @@ class Transaction:
         tx.block_index = json_data["block_index"]
         return tx
 
+    def write(self, writer):
+        # 二进制编码：哈希、签名和公钥直接保存原始字节，不用base64
+        writer.varint(len(self.inputs))
+        for utxo in self.inputs:
+            utxo.write(writer)
+        writer.varint(len(self.outputs))
+        for utxo in self.outputs:
+            utxo.write(writer)
+        writer.string(self.tx_hash)
+        writer.optional_bytes(self.signature)
+        writer.optional_bytes(self.sender_public_key)
+        writer.optional_number(self.block_index)
+
+    @classmethod
+    def read(cls, reader):
+        tx = cls()
+        tx.inputs = [UTXO.read(reader) for _ in range(reader.varint())]
+        tx.outputs = [UTXO.read(reader) for _ in range(reader.varint())]
+        tx.tx_hash = reader.string()
+        tx.signature = reader.optional_bytes()
+        tx.sender_public_key = reader.optional_bytes()
+        tx.block_index = reader.optional_number()
+        return tx
+
+    def to_bytes(self):
+        writer = Writer()
+        self.write(writer)
+        return writer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        reader = Reader(data)
+        tx = cls.read(reader)
+        reader.end()
+        return tx
+
     def add_input(self, utxo):
         self.inputs.append(utxo)
 
@@ -76,19 +144,16 @@ class Transaction:
         return self.tx_hash
 
     def sign(self, private_key):
-        # 使用私钥对交易进行签名
-        sk = ecdsa.SigningKey.from_string(private_key, curve=ecdsa.SECP256k1)
+        # 使用私钥对交易进行签名（密钥对象由签名后端缓存）
         message_hash = hashlib.sha256(self.tx_hash.encode('utf-8')).digest()
-        self.signature = sk.sign(message_hash)
-        self.sender_public_key = b'\x04' + sk.verifying_key.to_string()  # 存储发送者的公钥
+        self.signature = Signing.sign(private_key, message_hash)
+        self.sender_public_key = Signing.public_key(private_key)  # 存储发送者的公钥
 
     def verify_signature(self):
-        try:
-            vk = ecdsa.VerifyingKey.from_string(self.sender_public_key[1:], curve=ecdsa.SECP256k1)
-            message_hash = hashlib.sha256(self.tx_hash.encode('utf-8')).digest()
-            return vk.verify(self.signature, message_hash)
-        except ecdsa.BadSignatureError:
+        if self.signature is None or self.sender_public_key is None:
             return False
+        message_hash = hashlib.sha256(self.tx_hash.encode('utf-8')).digest()
+        return Signing.verify(self.sender_public_key, self.signature, message_hash)
 
     def get_tx_content(self):
         # 返回交易内容的字符串表示
@@ -101,6 +166,74 @@ class Transaction:
     def __repr__(self):
         return f"Transaction(inputs={self.inputs}, outputs={self.outputs}, tx_hash={self.tx_hash})"
 
+class TransactionCache:
+    """默克尔叶子哈希 -> (解析后的交易, 规范JSON字符串) 的LRU缓存。
+
+    验证、更新UTXO池和构建区块模板共用，同一笔交易在节点运行期间只解码和序列化一次。
+    缓存中的交易对象是共享的，使用者不应修改它们。
+    """
+
+    def __init__(self, size=TX_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()  # 格式: {叶子哈希: (交易或None, 叶子数据, 叶子是否为交易的规范JSON或None表示未知)}
+        self.leaf_hashes = {}  # 交易哈希 -> 叶子哈希，用于从交易对象找到它的序列化结果
+        self.lock = threading.Lock()
+
+    def remember(self, leaf_hash, tx, data, canonical=None):
+        # 调用者需持有self.lock
+        self.entries[leaf_hash] = (tx, data, canonical)
+        self.entries.move_to_end(leaf_hash)
+        if tx is not None:
+            self.leaf_hashes[tx.tx_hash] = leaf_hash
+        while len(self.entries) > self.size:
+            old_leaf_hash, (old_tx, _, _) = self.entries.popitem(last=False)
+            # 不同叶子可能声称同一个交易哈希，只删除仍指向被淘汰叶子的映射
+            if old_tx is not None and self.leaf_hashes.get(old_tx.tx_hash) == old_leaf_hash:
+                del self.leaf_hashes[old_tx.tx_hash]
+
+    def parse_leaf(self, leaf):
+        """返回默克尔叶子对应的交易，叶子不是交易时返回None"""
+        with self.lock:
+            entry = self.entries.get(leaf.hash)
+            if entry is not None:
+                self.entries.move_to_end(leaf.hash)
+                return entry[0]
+        try:
+            tx = Transaction.from_json(json.loads(leaf.data))
+        except Exception:
+            tx = None  # 非交易数据也缓存下来，避免反复尝试解析
+        with self.lock:
+            self.remember(leaf.hash, tx, leaf.data)
+        return tx
+
+    def serialize(self, tx):
+        """返回交易作为默克尔叶子的规范JSON字符串"""
+        with self.lock:
+            entry = self.entries.get(self.leaf_hashes.get(tx.tx_hash))
+            if entry is not None and entry[0] is tx:
+                return entry[1]
+        data = json.dumps(tx.to_json())
+        with self.lock:
+            self.remember(hashlib.sha256(data.encode("utf-8")).hexdigest(), tx, data, True)
+        return data
+
+    def binary_transaction(self, leaf):
+        """叶子数据正好是交易的规范JSON时返回交易，可以按交易的二进制格式编码，否则返回None；检查结果随叶子缓存"""
+        tx = self.parse_leaf(leaf)
+        if tx is None:
+            return None
+        with self.lock:
+            entry = self.entries.get(leaf.hash)
+            canonical = entry[2] if entry is not None else None
+        if canonical is None:
+            canonical = json.dumps(tx.to_json()) == leaf.data
+            with self.lock:
+                entry = self.entries.get(leaf.hash)
+                if entry is not None and entry[0] is tx:
+                    self.entries[leaf.hash] = (tx, entry[1], canonical)
+        return tx if canonical else None
+
+
 if __name__ == "__main__":  
     mining_reward = Transaction()
     reward_output = UTXO(
@@ -114,6 +247,7 @@ if __name__ == "__main__":
     print(mining_reward)
     print(mining_reward.to_json())
     print(Transaction.from_json(mining_reward.to_json()))
+    print(Transaction.from_bytes(mining_reward.to_bytes()))
 #     tx = Transaction()
 #     tx.add_input(UTXO(tx_hash="123", output_index=0, amount=100, recipient_address="0x123"))
 #     tx.add_output(amount=100, recipient_address="0x123")
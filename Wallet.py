@@ -1,14 +1,12 @@
 import random
-import ecdsa
 import hashlib
 import base58
+import Signing
 from Transaction import Transaction, UTXO
 
 # 生成公钥
 def generate_public_key(private_key):
-    sk = ecdsa.SigningKey.from_string(private_key, curve=ecdsa.SECP256k1)
-    vk = sk.verifying_key
-    return b'\x04' + vk.to_string()
+    return Signing.public_key(private_key)
 
 # 生成比特币地址
 def generate_btc_address(public_key):
@@ -32,17 +30,9 @@ def generate_btc_address(public_key):
 
 # 验证签名
 def verify_signature(public_key, message, signature):
-    try:
-        # 从完整公钥中移除前缀0x04
-        public_key_bytes = public_key[1:] if public_key[0] == 0x04 else public_key
-        # 创建验证密钥对象
-        vk = ecdsa.VerifyingKey.from_string(public_key_bytes, curve=ecdsa.SECP256k1)
-        # 对消息进行相同的哈希处理
-        message_hash = hashlib.sha256(message.encode()).digest()
-        # 验证签名
-        return vk.verify(signature, message_hash)
-    except:
-        return False
+    # 对消息进行相同的哈希处理，再由签名后端验证（公钥可以带或不带0x04前缀）
+    message_hash = hashlib.sha256(message.encode()).digest()
+    return Signing.verify(public_key, signature, message_hash)
 
 class Wallet:
     def __init__(self):
@@ -56,23 +46,21 @@ class Wallet:
 
     # 签名消息
     def sign_message(self, message):
-        sk = ecdsa.SigningKey.from_string(self.private_key, curve=ecdsa.SECP256k1)
         # 首先对消息进行哈希处理
         message_hash = hashlib.sha256(message.encode()).digest()
-        signature = sk.sign(message_hash)
-        return signature
+        return Signing.sign(self.private_key, message_hash)
 
-    def create_transaction(self, recipient_address, amount):
-        # 1. 选择足够的UTXO
+    def create_transaction(self, recipient_address, amount, fee=0):
+        # 1. 选择足够的UTXO（包括付给矿工的手续费）
         selected_utxos = []
         total_amount = 0
         for utxo in self.utxo_pool:
             selected_utxos.append(utxo)
             total_amount += utxo.amount
-            if total_amount >= amount:
+            if total_amount >= amount + fee:
                 break
 
-        if total_amount < amount:
+        if total_amount < amount + fee:
             raise ValueError("Don't have enough coins")
 
         # 2. 创建交易
@@ -83,8 +71,8 @@ class Wallet:
         # 3. 创建交易输出
         tx.add_output(amount, recipient_address)
 
-        # 4. 找零
-        change = total_amount - amount
+        # 4. 找零，输入多出输出的部分就是手续费
+        change = total_amount - amount - fee
         if change > 0:
             tx.add_output(change, self.address)
 
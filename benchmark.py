@@ -0,0 +1,131 @@
+import hashlib
+import json
+import random
+import sys
+import time
+import tracemalloc
+from MerkleTree import MerkleTree, FlatMerkleTree
+from Block import Block, block_from_bytes, block_from_json
+from Transaction import Transaction, TransactionCache, UTXO
+from Wallet import Wallet
+import Signing
+
+
+def measure(build):
+    # 返回(构建耗时秒, 构建结果占用的内存字节数)；计时与内存分开测，避免tracemalloc拖慢计时
+    start = time.perf_counter()
+    build()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    result = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return elapsed, size
+
+
+def bench_merkle(count=10000):
+    """对比节点式MerkleTree和数组式FlatMerkleTree的构建时间与内存占用"""
+    data = [f"transaction {i}" for i in range(count)]
+    print(f"=== Merkle tree, {count} leaves ===")
+    for name, cls in (("MerkleTree", MerkleTree), ("FlatMerkleTree", FlatMerkleTree)):
+        elapsed, size = measure(lambda: cls(data))
+        print(f"{name:<16} build {elapsed * 1000:8.1f} ms   memory {size / 1024:10.1f} KiB")
+
+
+def time_per_call(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+def sample_transactions(count):
+    # 带真实签名和公钥的转账交易
+    sender, recipient = Wallet(), Wallet()
+    transactions = []
+    for i in range(count):
+        sender.utxo_pool = [UTXO(f"{i:064x}", 0, 100, sender.address)]
+        transactions.append(sender.create_transaction(recipient.address, 30))
+    return transactions
+
+
+def bench_codec(count=100, repeat=200):
+    """对比JSON与二进制编码的编码/解码耗时和大小"""
+    transactions = sample_transactions(count)
+    coinbase = Transaction()
+    coinbase.outputs.append(UTXO(None, 0, 50, transactions[0].outputs[0].recipient_address))
+    coinbase.block_index = 1
+    coinbase.calculate_hash()
+    leaves = [json.dumps(tx.to_json()) for tx in [coinbase] + transactions]
+    block = Block(1, MerkleTree(leaves), "0" * 64, 0)
+    tx = transactions[0]
+    utxo = tx.inputs[0]
+    tx_cache = TransactionCache()  # 节点转发区块时用交易缓存编码叶子，不再逐个解析
+    cases = [
+        ("UTXO", utxo, lambda: json.dumps(utxo.to_json()), lambda d: UTXO.from_json(json.loads(d)),
+         utxo.to_bytes, UTXO.from_bytes),
+        ("Transaction", tx, lambda: json.dumps(tx.to_json()), lambda d: Transaction.from_json(json.loads(d)),
+         tx.to_bytes, Transaction.from_bytes),
+        (f"Block({count + 1} tx)", block, block.to_json, block_from_json, block.to_bytes, block_from_bytes),
+        ("Block(cached tx)", block, block.to_json, block_from_json,
+         lambda: block.to_bytes(tx_cache.binary_transaction), block_from_bytes),
+    ]
+    print(f"=== Codec, {repeat} rounds ===")
+    for name, _, json_encode, json_decode, binary_encode, binary_decode in cases:
+        rounds = max(1, repeat // 20) if name.startswith("Block") else repeat
+        for codec, encode, decode in (("json", json_encode, json_decode), ("binary", binary_encode, binary_decode)):
+            data = encode()
+            encode_time = time_per_call(encode, rounds)
+            decode_time = time_per_call(lambda: decode(data), rounds)
+            print(f"{name:<16} {codec:<7} size {len(data):8d} B   encode {encode_time * 1e6:10.1f} us"
+                  f"   decode {decode_time * 1e6:10.1f} us")
+
+
+def ops_per_second(function, seconds=0.5):
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        function()
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+def verify_with_new_backend(backend, public_keys, signatures, i, data):
+    # 新建后端实例，相当于第一次见到这个公钥（没有缓存和预计算表）
+    return backend.__class__().verify(public_keys[i], signatures[i], data)
+
+
+def bench_crypto(keys=20):
+    """各签名后端的签名/验证速度：同一密钥反复使用（命中密钥缓存和预计算表）以及每次换一个新密钥"""
+    data = hashlib.sha256(b"benchmark").digest()
+    print(f"=== ECDSA backends ({', '.join(Signing.available_backends())}) ===")
+    for name in Signing.available_backends():
+        backend = Signing.BACKENDS[name]()
+        private_keys = [random.randbytes(32) for _ in range(keys)]
+        public_keys = [backend.public_key(key) for key in private_keys]
+        signatures = [backend.sign(key, data) for key in private_keys]
+        fresh = iter(range(10 ** 9))
+        results = {
+            "sign": ops_per_second(lambda: backend.sign(private_keys[0], data)),
+            "verify (same key)": ops_per_second(lambda: backend.verify(public_keys[0], signatures[0], data)),
+            "verify (new key)": ops_per_second(lambda: verify_with_new_backend(
+                backend, public_keys, signatures, next(fresh) % keys, data)),
+        }
+        # 与ecdsa后端互相验证，确保签名格式兼容
+        compatible = Signing.EcdsaBackend().verify(public_keys[1], signatures[1], data)
+        for operation, rate in results.items():
+            print(f"{name:<14} {operation:<18} {rate:10.0f} ops/s")
+        print(f"{name:<14} {'ecdsa-compatible':<18} {compatible}")
+
+
+BENCHMARKS = {
+    "merkle": bench_merkle,
+    "codec": bench_codec,
+    "crypto": bench_crypto,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()